@@ -1,160 +1,366 @@
 import ast
+import contextvars
+import json
 import os
 import re
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Callable, Optional
+from typing import Callable, List, Optional, Tuple
 
-from api.conversation import Conversation
-from scraper.scrape_results_page import scrape, scrape_with_1688_image_search
-from recorder import writeRuntimeState 
+import api.conversation as conversation
+from cassette import RECORD, eject_cassette, record_cassette, replay_cassette
+from api.context_window import ContextPolicy
+from api.conversation import Conversation, enable_response_cache
+from api.streaming import ACCEPT, PENDING, REJECT, ListValidator, StreamValidator
+from api.usage import LLMUsage, estimate_text_tokens, prometheus_text, track_llm_usage
+import scraper.scrape_results_page as scraper
+from scraper.scrape_results_page import iter_scrape, scrape, scrape_with_1688_image_search, parse_stats, enable_corpus_cache
+from scraper.page_readiness import readiness_stats
+from recorder import RunLog, createVisualizationFrom, readCheckpoint, writeCheckpoint
+import image_hash
+from image_store import configure_image_store
+from single_flight import single_flight_stats
+from tracing import Tracer, span, start_tracing, stop_tracing, traced
 
 sources = ["amazon", "1688"]
 
 current_date_time = datetime.now().strftime("%Y-%m-%d_%H-%M")
 run_dir = f"runs/run_{current_date_time}"
 
-def search_term_exploration(initial_term: str, recursions: int=2, branching_factor: int=3): 
-    global run_dir
-    run_dir = f"runs/run_{initial_term}_{datetime.now().strftime('%Y-%m-%d_%H-%M')}" 
+def search_term_exploration(initial_term: str, recursions: int=2, branching_factor: int=3, max_concurrency: int=1, listing_concurrency: int=5, llm_cache: Optional[str]=None, image_cache_dir: Optional[str]=None, corpus_cache: Optional[str]=None, resume: Optional[str]=None, match_reasons: bool=False, prometheus_export: bool=False, record_to: Optional[str]=None, replay_from: Optional[str]=None): 
+    global run_dir, include_match_reasons
+    include_match_reasons = match_reasons
+    run_dir = resume or f"runs/run_{initial_term}_{datetime.now().strftime('%Y-%m-%d_%H-%M')}" 
     os.makedirs(run_dir, exist_ok=True)
     
-    terms_so_far = set()
-    state = []    
-    queue = [{
-        "term": initial_term,
-        "parent": None,
-        "depth": 0
-    }]
-        
-    while len(queue) > 0:
-        element = queue.pop(0)
+    cache = enable_response_cache(llm_cache) if llm_cache else None
+    images = configure_image_store(disk_dir=image_cache_dir)
+    corpora = enable_corpus_cache(corpus_cache) if corpus_cache else None
+    
+    # record_to captures every page, image and llm answer of the run into a cassette directory,
+    # replay_from serves them back so the run needs no network (see benchmarks/bench_pipeline.py);
+    # anything answered from the caches above is not recorded, so record with them off
+    assert not (record_to and replay_from), "record_to and replay_from are exclusive"
+    if record_to and (cache or image_cache_dir or corpora):
+        print("[search_term_exploration] recording with caches enabled, cache hits will be missing from the cassette")
+    tape = record_cassette(record_to) if record_to else replay_cassette(replay_from) if replay_from else None
+    
+    run_log = RunLog(f"{run_dir}/term_search.jsonl")
+    checkpoint_path = f"{run_dir}/checkpoint.json"
+    checkpoint = readCheckpoint(checkpoint_path) if resume else None
+    if resume and checkpoint is None:
+        raise FileNotFoundError(f"no checkpoint to resume from in {run_dir}")
+    
+    if checkpoint is not None:
+        assert checkpoint["initial_term"] == initial_term, f"{run_dir} explores {checkpoint['initial_term']}, not {initial_term}"
+        recursions, branching_factor = checkpoint["recursions"], checkpoint["branching_factor"]
+        terms_so_far = set(checkpoint["terms_so_far"])
+        frontier, next_frontier = checkpoint["pending"], checkpoint["next_frontier"]
+        completed, failed, parents = checkpoint["completed"], checkpoint["failed"], checkpoint["parents"]
+        level_times = checkpoint["level_times"]
+        if not frontier:
+            # stopped after the last term of a level was recorded but before the level boundary
+            frontier, next_frontier = next_frontier, []
+        print(f"[search_term_exploration] resuming {run_dir} - {len(completed)} terms done, {len(frontier) + len(next_frontier)} queued")
+    else:
+        terms_so_far = set([initial_term])
+        frontier = [{
+            "term": initial_term,
+            "parent": None,
+            "depth": 0
+        }]
+        next_frontier = []
+        completed, failed, parents = [], [], {initial_term: None}
+        level_times = []
+    
+    def save_checkpoint(pending: list):
+        writeCheckpoint({
+            "initial_term": initial_term,
+            "recursions": recursions,
+            "branching_factor": branching_factor,
+            "pending": pending,
+            "next_frontier": next_frontier,
+            "terms_so_far": sorted(terms_so_far),
+            "completed": completed,
+            "failed": failed,
+            "parents": parents,
+            "level_times": level_times,
+        }, checkpoint_path)
+    
+    def record_term(element: dict, analysis: Optional[dict], c: Optional[Conversation], usage: LLMUsage) -> bool:
         term = element["term"]
-        parent = element["parent"]
         depth = element["depth"]
         
-        
-        analytics = generate_keyword_analytics(term)
-        if analytics is None:
-            print(f"analystics generation failed for keyword - {term}")
-            continue
-        
-        names, prices, ratings, reviews, purchases, margins, images = [], [], [], [], [], [], []
-        for analytic in analytics:
-            ol = analytic['original_listing']
-            names.append(ol['name'])
-            prices.append(ol['price'])
-            ratings.append(ol['rating'])
-            reviews.append(ol['reviews'])
-            purchases.append(ol['purchases'])
-            margins.append(analytic['estimated_margin'] if analytic['estimated_margin'] else "supplier not found, margin unknown")
-            images.append(ol['image'])
-        
-        c = Conversation(instruction=(
-            "I will provide webscraped search results on Amazon for select keywords. "
-            "Some scraped strings could be invalid, if so, ignore them. "
-            "Good profit margin is anything >50 percent; High volume is anything with more than 100 reviews or 1k purchases (purchases might not be scraped correctly, if so, ignore them). High price is anything >100 bucks; Good review is anything above 3.75 stars."
-        ))
-        analyst_feedback = c.message(
-            message=(
-                f"for the search term {term}, the following product info is found on Amazon\n"
-                f"names     - {names}\n"
-                f"prices    - {prices}\n"
-                f"ratings   - {ratings}\n"
-                f"reviews   - {reviews}\n"
-                f"purchases - {purchases}\n"
-                f"margins   - {margins}\n"
-                "images are attached\n"
-                "write a summary of how this keyword compares to previous ones if there were any\n"
-                "please give a bullet point summary each on profit margins, price range, number of reviews/purchases, ratings, and how different the listed products are\n"
-                "write the summary at the end on if this term is saturated or niche\n"
-            ),
-            images_urls=images
-        )
-        c.log_conversation(f"{run_dir}/term_analysis_{term}_{current_date_time}.yml")
-       
-        
-        analysis = {
-            "analytics": analytics,
-            "analyst_feedback": analyst_feedback
-        }
-        
         if analysis is None:
+            print(f"[analyze_term] llm usage for {term} - {summarize_usage(usage.as_dict())}")
             print(f"analysis failed for keyword - {term}")
-            return None
-        analysis["original_term"] = parent
+            return False
+        analysis["original_term"] = element["parent"]
         analysis["term"] = term
-        
-        state.append(analysis)
-        writeRuntimeState([analysis], f"{run_dir}/term_search.yml")
-
-        if depth >= recursions:
-            continue
 
+        # keyword expansion continues the term's conversation and counts towards its usage, so the
+        # record is written once it is done
+        new_terms = expand_term(c, term, terms_so_far, branching_factor) if depth < recursions else []
+        print(f"[analyze_term] llm usage for {term} - {summarize_usage(usage.as_dict())}")
+        analysis["llm_usage"] = usage.as_dict()
+        run_log.append(analysis, key=term)
 
-        valid = lambda x: is_valid_list_of(str, branching_factor)(x) and all(term not in terms_so_far for term in ast.literal_eval(x))
-        new_terms = c.message_until_response_valid(
-            valid=valid,
-            valid_criteria=f"answer should be a python list of {branching_factor} strings not including any elemet of {terms_so_far}, no talking, no markdown",
-            message=("what are some unique items from the search results I shared\n"
-                    "based on this, come up with more niche keywords which could have high profit margin and low competition\n"
-                    "the keywords should be short and something a user would likely type in")
-        )
-        c.log_conversation(f"{run_dir}/term_analysis_{term}_{current_date_time}.yml")
-        new_terms = ast.literal_eval(new_terms)
+        if new_terms is None:
+            print(f"keyword generation failed for keyword - {term}")
+            return True
         terms_so_far.update(new_terms)
         
         for new_term in new_terms:
-            queue.append({
+            parents[new_term] = term
+            next_frontier.append({
                 "term": new_term,
                 "parent": term,
                 "depth": depth + 1
             })
+        return True
+    
+    # terms of the same depth are analyzed concurrently, results are then recorded and expanded
+    # in frontier order so term_search.jsonl and terms_so_far stay deterministic; the checkpoint is
+    # rewritten after every recorded term so a crash (or ctrl-c) loses at most the terms in flight
+    save_checkpoint(frontier)
+    start_tracing()
+    # not a with block, whose exit would wait for every term in flight when the run is interrupted
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    with span("search_term_exploration", "analyst", initial_term=initial_term), track_llm_usage() as run_usage:
+        try:
+            while len(frontier) > 0:
+                depth = frontier[0]["depth"]
+                level_start = time.perf_counter()
+                
+                with span("exploration_level", "analyst", depth=depth, terms=len(frontier)):
+                    futures = [executor.submit(contextvars.copy_context().run, analyze_term, element["term"], listing_concurrency) for element in frontier]
+                
+                    for i, (element, future) in enumerate(zip(frontier, futures)):
+                        analysis, c, usage = future.result()
+                        (completed if record_term(element, analysis, c, usage) else failed).append(element["term"])
+                        save_checkpoint(frontier[i + 1:])
+                
+                level_time = time.perf_counter() - level_start
+                level_times.append({"depth": depth, "terms": len(frontier), "seconds": level_time})
+                print(f"[search_term_exploration] depth {depth} - {len(frontier)} terms took {level_time:.1f}s with max_concurrency={max_concurrency}")
+                frontier, next_frontier = next_frontier, []
+                save_checkpoint(frontier)
+            executor.shutdown()
+        except BaseException:
+            print(f"[search_term_exploration] stopped, continue with resume=\"{run_dir}\"")
+            executor.shutdown(wait=False, cancel_futures=True)
+            write_trace(stop_tracing())
+            if tape is not None:
+                eject_cassette()
+            raise
+    
+    if os.path.exists(run_log.path):
+        createVisualizationFrom(run_log.path, f"{run_dir}/term_search.json")
+    write_usage_summary(run_log, run_usage.as_dict(), prometheus_export)
+    write_trace(stop_tracing())
+    if tape is not None:
+        eject_cassette()
+    
+    for level in level_times:
+        print(f"[search_term_exploration] depth {level['depth']}: {level['terms']} terms, {level['seconds']:.1f}s")
+    print(f"[search_term_exploration] llm usage - {summarize_usage(run_usage.as_dict())}")
+    if cache is not None:
+        print(f"[search_term_exploration] llm response cache - {cache.stats()}")
+    print(f"[search_term_exploration] image store - {images.stats()}")
+    print(f"[search_term_exploration] perceptual hash prefilter - {image_hash.prefilter.stats()}")
+    if conversation.image_preparer is not None:
+        print(f"[search_term_exploration] llm image preparation - {conversation.image_preparer.stats()}")
+    if corpora is not None:
+        print(f"[search_term_exploration] corpus cache - {corpora.stats()}")
+    print(f"[search_term_exploration] page readiness waits - {readiness_stats()}")
+    print(f"[search_term_exploration] page parses per layout - {parse_stats()}")
+    print(f"[search_term_exploration] fetch scheduler - {scraper.fetch_scheduler.stats()}")
+    print(f"[search_term_exploration] collapsed duplicate fetches - {single_flight_stats()}")
+    if tape is not None:
+        if tape.mode == RECORD:
+            tape.write_metadata({
+                "initial_term": initial_term,
+                "recursions": recursions,
+                "branching_factor": branching_factor,
+                "completed": completed,
+                "failed": failed,
+            })
+        print(f"[search_term_exploration] cassette {tape.path} - {tape.stats()}")
+    proxies = scraper.proxy_pool.stats()
+    print(f"[search_term_exploration] proxy pool - {proxies['healthy']} healthy, {proxies['ejected']} ejected after {proxies['refreshes']} refreshes")
+    return level_times
+
+def write_trace(tracer: Optional[Tracer]):
+    # chrome trace of every span in the run (open in chrome://tracing or ui.perfetto.dev) and the
+    # stages ranked by cumulative time
+    if tracer is None:
+        return
+    tracer.write_chrome_trace(f"{run_dir}/trace.json")
+    report = tracer.hotspot_report()
+    with open(f"{run_dir}/hotspots.txt", "w", encoding="utf-8") as file:
+        file.write(report + "\n")
+    print(f"[search_term_exploration] hotspots\n{report}")
+
+def summarize_usage(usage: dict) -> str:
+    return (f"{usage['requests']} requests ({usage['cached']} cached, {usage['failures']} failed, {usage['retries']} retries, "
+            f"{usage['early_accepts']} accepted / {usage['early_rejects']} rejected while streaming), "
+            f"{usage['input_tokens']} input / {usage['output_tokens']} output tokens (~{usage['image_tokens']} for {usage['images_sent']} images), "
+            f"{usage['cache_read_tokens']} input tokens from prompt cache, ~{usage['pruned_tokens']} left out of context ({usage['pruned_images']} images), "
+            f"{usage['latency_seconds']:.1f}s waiting (max {usage['max_latency_seconds']:.1f}s), ${usage['cost_usd']:.4f}")
+
+def write_usage_summary(run_log: RunLog, run_usage: dict, prometheus_export: bool = False):
+    # llm usage of this invocation, and of every term recorded in the run log (including terms from
+    # before a resume)
+    terms = {record["term"]: record["llm_usage"] for record in run_log if "llm_usage" in record} if os.path.exists(run_log.path) else {}
+    with open(f"{run_dir}/llm_usage.json", "w", encoding="utf-8") as file:
+        json.dump({"run": run_usage, "terms": terms}, file, ensure_ascii=False, indent=2)
+    if prometheus_export:
+        scopes = [({"scope": "run"}, run_usage)] + [({"scope": "term", "term": term}, usage) for term, usage in terms.items()]
+        with open(f"{run_dir}/llm_usage.prom", "w", encoding="utf-8") as file:
+            file.write(prometheus_text(scopes))
+
+def analyze_term(term: str, listing_concurrency: int = 5) -> Tuple[Optional[dict], Optional[Conversation], LLMUsage]:
+    # the term's usage scope is returned along with its conversation, whose later calls (keyword
+    # expansion) still count towards it
+    with span("analyze_term", "analyst", term=term), track_llm_usage() as usage:
+        analysis, c = analyze_term_with_usage(term, listing_concurrency)
+    return analysis, c, usage
+
+# the listing images are only needed for the analysis turn, keyword expansion and its retries go
+# without them; dropping them changes the prefix the analysis turn cached, so the first expansion
+# call is a cache miss that writes the image-free history, and only its retries read it back
+exploration_context = ContextPolicy(image_exchanges=1, cache_prefix=True)
+
+def analyze_term_with_usage(term: str, listing_concurrency: int = 5) -> Tuple[Optional[dict], Optional[Conversation]]:
+    analytics = generate_keyword_analytics(term, listing_concurrency)
+    if analytics is None:
+        print(f"analystics generation failed for keyword - {term}")
+        return None, None
+    
+    names, prices, ratings, reviews, purchases, margins, images = [], [], [], [], [], [], []
+    for analytic in analytics:
+        ol = analytic['original_listing']
+        names.append(ol['name'])
+        prices.append(ol['price'])
+        ratings.append(ol['rating'])
+        reviews.append(ol['reviews'])
+        purchases.append(ol['purchases'])
+        margins.append(analytic['estimated_margin'] if analytic['estimated_margin'] else "supplier not found, margin unknown")
+        images.append(ol['image'])
+    
+    c = Conversation(context_policy=exploration_context, instruction=(
+        "I will provide webscraped search results on Amazon for select keywords. "
+        "Some scraped strings could be invalid, if so, ignore them. "
+        "Good profit margin is anything >50 percent; High volume is anything with more than 100 reviews or 1k purchases (purchases might not be scraped correctly, if so, ignore them). High price is anything >100 bucks; Good review is anything above 3.75 stars."
+    ))
+    analyst_feedback = c.message(
+        message=(
+            f"for the search term {term}, the following product info is found on Amazon\n"
+            f"names     - {names}\n"
+            f"prices    - {prices}\n"
+            f"ratings   - {ratings}\n"
+            f"reviews   - {reviews}\n"
+            f"purchases - {purchases}\n"
+            f"margins   - {margins}\n"
+            "images are attached\n"
+            "write a summary of how this keyword compares to previous ones if there were any\n"
+            "please give a bullet point summary each on profit margins, price range, number of reviews/purchases, ratings, and how different the listed products are\n"
+            "write the summary at the end on if this term is saturated or niche\n"
+        ),
+        images_urls=images
+    )
+    c.log_conversation(f"{run_dir}/term_analysis_{term}_{current_date_time}.yml")
+    
+    analysis = {
+        "analytics": analytics,
+        "analyst_feedback": analyst_feedback
+    }
+    return analysis, c
 
-def generate_keyword_analytics(keyword: str) -> Optional[list]:
-    search_results = scrape(
+@traced("expand_term", "analyst")
+def expand_term(c: Conversation, term: str, terms_so_far: set, branching_factor: int) -> Optional[list]:
+    valid = lambda x: is_valid_list_of(str, branching_factor)(x) and all(term not in terms_so_far for term in ast.literal_eval(x))
+    new_terms = c.message_until_response_valid(
+        valid=valid,
+        valid_criteria=f"answer should be a python list of {branching_factor} strings not including any elemet of {terms_so_far}, no talking, no markdown",
+        validator=ListValidator(str, branching_factor),
+        message=("what are some unique items from the search results I shared\n"
+                "based on this, come up with more niche keywords which could have high profit margin and low competition\n"
+                "the keywords should be short and something a user would likely type in")
+    )
+    c.log_conversation(f"{run_dir}/term_analysis_{term}_{current_date_time}.yml")
+    
+    if new_terms is None:
+        return None
+    return ast.literal_eval(new_terms)
+
+@traced("generate_keyword_analytics", "analyst")
+def generate_keyword_analytics(keyword: str, listing_concurrency: int = 5) -> Optional[list]:
+    search_results = iter_scrape(
         keyword=keyword,
         source="amazon",
         max_results=5,
         remove_partially_extracted=True,
         result_output=f"{run_dir}/amazon_{current_date_time}_{clean_file_path(keyword)}.jsonl",
     )
-    if search_results is None:
+    
+    # listings are independent, so each one is sourced on its own worker as soon as it is scraped and
+    # collected back in listing order
+    listings, futures = [], []
+    with ThreadPoolExecutor(max_workers=max(1, listing_concurrency)) as executor:
+        for listing in search_results:
+            listings.append(listing)
+            futures.append(executor.submit(contextvars.copy_context().run, analyze_listing, listing))
+    
+    if not listings:
         print(f"failed to get amazon search results for {keyword}")
         return None
     
     analytics = []
-    
-    for listing in search_results:
+    for listing, future in zip(listings, futures):
         try:
-            result = analyze_product_sourcing_with_image_search(listing)
-            if result is None or len(result) == 0:
-                raise ValueError("No valid result")
-            
+            listing_analytic = future.result()
+        except Exception as e:
+            print(f"Error processing listing: {e}")
+            listing_analytic = empty_listing_analytic(listing)
+        analytics.append(listing_analytic)
+        
+    return analytics
+
+@traced("analyze_listing", "analyst")
+def analyze_listing(listing: dict) -> dict:
+    try:
+        result = analyze_product_sourcing_with_image_search(listing)
+        if result is None or len(result) == 0:
+            raise ValueError("No valid result")
+        
+        with span("margin_estimate", "analyst"):
             listing_cost = float(listing['price'][1:])
             cost_of_matches = [pair['usd_cost'] for pair in result if pair['match']]
             
             estimated_cost = sum(cost_of_matches) / len(cost_of_matches) if len(cost_of_matches) > 0 else None
             estimated_margin = (listing_cost - estimated_cost) / listing_cost if estimated_cost else None
-            listing_analytic = {
-                "original_listing": listing,
-                "comparisons": result,
-                "estimated_cost": estimated_cost,
-                "estimated_margin": estimated_margin,
-            }
-        except ValueError as e:
-            print(f"Error processing listing: {e}")
-            listing_analytic = {
-                "original_listing": listing,
-                "comparisons": [],
-                "estimated_cost": None,
-                "estimated_margin": None,
-            }
-        
-        analytics.append(listing_analytic)
-        
-    return analytics
+        return {
+            "original_listing": listing,
+            "comparisons": result,
+            "estimated_cost": estimated_cost,
+            "estimated_margin": estimated_margin,
+        }
+    except ValueError as e:
+        print(f"Error processing listing: {e}")
+        return empty_listing_analytic(listing)
+
+def empty_listing_analytic(listing: dict) -> dict:
+    return {
+        "original_listing": listing,
+        "comparisons": [],
+        "estimated_cost": None,
+        "estimated_margin": None,
+    }
 
+@traced("analyze_product_sourcing_with_keyword_search", "analyst")
 def analyze_product_sourcing_with_keyword_search(listing: dict, generate_report: bool = True) -> Optional[list]:
     assert set(["name", "price", "image", "url"]).issubset(set(listing.keys())), "listing should have name and image keys"
     
@@ -198,8 +404,8 @@ def analyze_product_sourcing_with_keyword_search(listing: dict, generate_report:
             break
         
         matches = 0
-        for supplier_listing in listings:
-            is_match = match_product_supplier_pair(listing, supplier_listing)
+        for match, supplier_listing in zip(match_supplier_candidates(listing, listings, with_reasons=include_match_reasons) or [None] * len(listings), listings):
+            is_match = match["match"] if match else None
             if is_match:
                 matches += 1
                 
@@ -208,6 +414,8 @@ def analyze_product_sourcing_with_keyword_search(listing: dict, generate_report:
                 "usd_cost": toUSD(float(supplier_listing['price']), "1688"), # 1688 price is in RMB
                 "supplier_listing": supplier_listing
             }
+            if match and "reason" in match:
+                pair["reason"] = match["reason"]
             results.append(pair)
         
         is_new = lambda term: term not in used_terms
@@ -228,11 +436,10 @@ def analyze_product_sourcing_with_keyword_search(listing: dict, generate_report:
     c.log_conversation(f"{run_dir}/term_generation_{clean_file_path(listing['name'])}_{current_date_time}.yml")
     return results
 
+@traced("analyze_product_sourcing_with_image_search", "analyst")
 def analyze_product_sourcing_with_image_search(listing: dict, generate_report: bool = True) -> Optional[list]:
     assert set(["name", "price", "image", "url"]).issubset(set(listing.keys())), "listing should have name and image keys"
     
-    c = Conversation()
-    
     listing_name = listing['name']
     suggested_listings = scrape_with_1688_image_search(
         image_urls=[listing["image"]],
@@ -245,76 +452,171 @@ def analyze_product_sourcing_with_image_search(listing: dict, generate_report: b
         print(f"image search failed for Amazon listing - {listing['name']}")
         return None
      
-    requirements_string = f"answer should be a python list of {len(suggested_listings)} booleans, no talking, no markdown"
-    evaluation = is_valid_list_of(bool, len(suggested_listings))
-    question_string = (
-        "the Amazon product\n"
-        f"{listing['name']}\n"
-        "has an Amazon thumbnail attached as the first image below\n\n"
-        "products from 1688 have names and thumbnails listed after in the same order\n"
-        "return a list of booleans, for if each of the 1688 product can be sold as the Amazon one\n\n"
-    )
-    for suggested_listing in suggested_listings:
-        question_string += f"{suggested_listing['name']}\n\n"
-    
-    result = c.message_until_response_valid(
-        valid=evaluation,
-        valid_criteria=requirements_string,
-        message=question_string,
-        images_urls=[listing['image']] + [listing['image'] for listing in suggested_listings]
-    )
-    
-    if result is None:
+    matches = match_supplier_candidates(listing, suggested_listings, with_reasons=include_match_reasons)
+    if matches is None:
         print(f"matching failed for Amazon listing - {listing['name']}")
         return None
     
-    matches = ast.literal_eval(result)
-    
     pairs = []
-    for is_match, supplier_listing in zip(matches, suggested_listings):
+    for match, supplier_listing in zip(matches, suggested_listings):
+        if match is None:
+            continue
         try:
             usd_cost = toUSD(float(supplier_listing['price']), "1688")
-            pairs.append({
-                "match": is_match,
-                "usd_cost": usd_cost,
-                "supplier_listing": supplier_listing
-            })
+            pairs.append(dict(match, usd_cost=usd_cost, supplier_listing=supplier_listing))
         except ValueError as e:
             print(f"Error processing listing: {e}")
             continue
     
-    c.message("give a short reason for each answer")
-    
-    c.log_conversation(f"{run_dir}/image_search_{clean_file_path(listing['name'])}_{current_date_time}.yml")
-    
     return pairs
 
-def match_product_supplier_pair(listing: dict, against_listing: dict) -> Optional[bool]:
+# the batch matcher packs an amazon listing and as many 1688 candidates as fit in the image and token
+# budgets into each request, asking for structured json instead of a python list; reasons are opt-in
+include_match_reasons = False
+match_max_images = 20
+match_max_input_tokens = 24000
+image_token_estimate = 800 # roughly what one thumbnail costs either provider
+
+def pack_match_batches(listing: dict, candidates: list, max_images: int, max_input_tokens: int) -> List[List[int]]:
+    # candidates without an image are left out (TODO: support 1688 listings with videos instead of images)
+    base_tokens = 300 + estimate_text_tokens(listing['name']) + image_token_estimate
+    batches, batch, batch_tokens = [], [], base_tokens
+    for i, candidate in enumerate(candidates):
+        if candidate.get("image") is None:
+            continue
+        tokens = estimate_text_tokens(candidate['name']) + image_token_estimate
+        if batch and (len(batch) + 2 > max_images or batch_tokens + tokens > max_input_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], base_tokens
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def parse_match_response(string: str, count: int, with_reasons: bool) -> Optional[list]:
+    try:
+        matches = json.loads(string.strip().removeprefix("```json").strip("`"))["matches"]
+        by_candidate = {int(match["candidate"]): match for match in matches}
+        if sorted(by_candidate) != list(range(1, count + 1)):
+            return None
+        if not all(isinstance(match["match"], bool) for match in matches):
+            return None
+        return [
+            {"match": by_candidate[n]["match"], "reason": str(by_candidate[n].get("reason") or "")} if with_reasons else {"match": by_candidate[n]["match"]}
+            for n in range(1, count + 1)
+        ]
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+
+class MatchResponseValidator(StreamValidator):
+    # judges the {"matches": [...]} answer entry by entry as it streams: an entry parse_match_response
+    # would refuse (candidate out of range, match not a bool) cuts the answer off, and it is accepted
+    # once the object closes; answers with other keys before "matches" are only judged when complete
+    def __init__(self, count: int, with_reasons: bool):
+        self.count = count
+        self.with_reasons = with_reasons
+        self.decoder = json.JSONDecoder()
+
+    def check(self, partial: str) -> Tuple[str, Optional[str]]:
+        text = partial.lstrip()
+        if "```json".startswith(text):
+            return PENDING, None
+        text = text.removeprefix("```json").lstrip("`").lstrip()
+        if not text:
+            return PENDING, None
+        if text[0] != "{":
+            return REJECT, None
+
+        try:
+            _, end = self.decoder.raw_decode(text)
+        except ValueError:
+            pass
+        else:
+            answer = text[:end]
+            if parse_match_response(answer, self.count, self.with_reasons) is None:
+                return REJECT, None
+            return ACCEPT, answer
+
+        entries = re.match(r'\{\s*"matches"\s*:\s*\[', text)
+        if entries is None:
+            return PENDING, None
+        position = entries.end()
+        while True:
+            while position < len(text) and (text[position].isspace() or text[position] == ","):
+                position += 1
+            if position == len(text) or text[position] == "]":
+                return PENDING, None
+            try:
+                entry, position = self.decoder.raw_decode(text, position)
+            except ValueError:
+                return PENDING, None # the entry is still arriving
+            if not self._valid_entry(entry):
+                return REJECT, None
+
+    def _valid_entry(self, entry) -> bool:
+        try:
+            return 1 <= int(entry["candidate"]) <= self.count and isinstance(entry["match"], bool)
+        except (ValueError, TypeError, KeyError):
+            return False
+
+    def __repr__(self) -> str:
+        return f"MatchResponseValidator({self.count}, with_reasons={self.with_reasons})"
+
+@traced("match_supplier_candidates", "analyst")
+def match_supplier_candidates(listing: dict, candidates: list, with_reasons: bool = False, max_images: Optional[int] = None, max_input_tokens: Optional[int] = None) -> Optional[list]:
+    # returns one {"match": bool} (plus "reason" when asked) per candidate, None for candidates that
+    # could not be judged, or None altogether when the model was needed but no batch was answered
     assert set(["name", "image"]).issubset(set(listing.keys())), "listing should have name and image keys"
-    assert set(["name", "image"]).issubset(set(against_listing.keys())), "against_listing should have name and image keys"
-    
-    c = Conversation()
     
-    if against_listing["image"] is None: # TODO: support 1688 listings with videos instead of images
-        return None
+    results = [None] * len(candidates)
     
-    result = c.message_until_response_valid(
-        valid=lambda x: x.lower() in ["yes", "no"],
-        valid_criteria="the answer should be just 'yes' or 'no' in lower case",
-        message=("the first product is\n"
-                f"{listing['name']}\n"
-                "the second is\n"
-                f"{against_listing['name']}\n"
-                "their images are listed in order. Can I sell the second one as the first one?"),
-        images_urls=[listing['image'], against_listing['image']]
-    )
+    # near duplicate and clearly unrelated thumbnails are settled by perceptual hashes, only the
+    # ambiguous middle is sent to the model
+    prefilter = image_hash.prefilter
+    with span("hash_prefilter", "analyst", candidates=len(candidates)), ThreadPoolExecutor(max_workers=8) as executor:
+        judgements = list(executor.map(
+            lambda candidate: prefilter.judge(listing['image'], candidate['image']) if candidate.get("image") else (None, None),
+            candidates
+        ))
+    for i, (decision, distances) in enumerate(judgements):
+        if decision is not None:
+            results[i] = {"match": decision}
+            if with_reasons:
+                results[i]["reason"] = f"{'near duplicate' if decision else 'clearly different'} image (phash distance {distances[0]}, dhash distance {distances[1]})"
+    undecided = [i for i, result in enumerate(results) if result is None]
     
-    if result is None:
-        return None
+    batches = [
+        [undecided[i] for i in batch]
+        for batch in pack_match_batches(listing, [candidates[i] for i in undecided], max_images or match_max_images, max_input_tokens or match_max_input_tokens)
+    ]
+    answered = 0
+    for batch_number, batch in enumerate(batches):
+        entry = '{"candidate": <number>, "match": <true or false>' + (', "reason": "<one short sentence>"' if with_reasons else '') + '}'
+        c = Conversation()
+        result = c.message_until_response_valid(
+            valid=lambda x: parse_match_response(x, len(batch), with_reasons) is not None,
+            valid_criteria=f'answer with a json object {{"matches": [{entry}, ...]}} holding one entry per candidate, no talking, no markdown',
+            message=("the Amazon product\n"
+                    f"{listing['name']}\n"
+                    "has an Amazon thumbnail attached as the first image below\n\n"
+                    "numbered products from 1688 are listed next, their thumbnails are attached after it in the same order\n"
+                    + "".join(f"{n}. {candidates[i]['name']}\n" for n, i in enumerate(batch, 1)) +
+                    "\nfor each 1688 product, decide if it can be sold as the Amazon one\n"),
+            images_urls=[listing['image']] + [candidates[i]['image'] for i in batch],
+            json_response=True,
+            validator=MatchResponseValidator(len(batch), with_reasons)
+        )
+        c.log_conversation(f"{run_dir}/matching_{clean_file_path(listing['name'])}_{batch_number}_{current_date_time}.yml")
+        
+        if result is None:
+            print(f"matching batch {batch_number + 1}/{len(batches)} failed for Amazon listing - {listing['name']}")
+            continue
+        answered += 1
+        for i, match in zip(batch, parse_match_response(result, len(batch), with_reasons)):
+            results[i] = match
     
-    c.message("why?")
-    c.log_conversation(f"{run_dir}/matching_against_{clean_file_path(listing['name'])}.yml")
-    return "yes" in result.lower()
+    return None if batches and answered == 0 else results
 
 def languageOf(source: str) -> str:
     assert source in sources, f"source should be one of {sources}"
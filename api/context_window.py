@@ -0,0 +1,101 @@
+from typing import List, Optional, Tuple
+
+from api.usage import estimate_text_tokens
+
+class ContextPolicy:
+    # decides which part of a conversation's transcript is sent to the provider; the transcript (and
+    # its log) keeps every turn. turns are grouped in exchanges, a user message and everything up to
+    # the next one, with retries of message_until_response_valid counted as part of their exchange
+    #
+    # image_exchanges - images are only sent for the last n exchanges, older ones are replaced by a
+    #     short note (or dropped with image_placeholder=False)
+    # max_history_tokens - the oldest exchanges are left out until the estimate fits, the current
+    #     exchange is always sent
+    # cache_prefix - marks the system prompt, the start of the current exchange and the last message
+    #     as anthropic cache breakpoints, so retries and follow ups read the prefix from the cache
+    #     (openai caches prefixes of 1024+ tokens on its own)
+    def __init__(self, image_exchanges: Optional[int] = None, image_placeholder: bool = True, max_history_tokens: Optional[int] = None, cache_prefix: bool = False):
+        assert image_exchanges is None or image_exchanges >= 1, "image_exchanges should be at least 1, the current exchange needs its images"
+        self.image_exchanges = image_exchanges
+        self.image_placeholder = image_placeholder
+        self.max_history_tokens = max_history_tokens
+        self.cache_prefix = cache_prefix
+
+    @property
+    def settings(self) -> dict:
+        return {
+            "image_exchanges": self.image_exchanges,
+            "image_placeholder": self.image_placeholder,
+            "max_history_tokens": self.max_history_tokens,
+            "cache_prefix": self.cache_prefix,
+        }
+
+    def view(self, transcript: list, follow_ups: list, image_tokens: int) -> Tuple[list, int, int]:
+        # returns the messages to send, the number of images left out and an estimate of the input
+        # tokens saved
+        system = [m for m in transcript if m["role"] == "system"]
+        exchanges = split_exchanges([m for m in transcript if m["role"] != "system"], follow_ups)
+        pruned_images, pruned_tokens = 0, 0
+
+        if self.image_exchanges is not None:
+            kept = len(exchanges) - self.image_exchanges
+            for i in range(max(0, kept)):
+                exchanges[i], count = self._without_images(exchanges[i])
+                pruned_images += count
+                pruned_tokens += count * image_tokens
+
+        if self.max_history_tokens is not None:
+            budget = self.max_history_tokens - sum(estimate_message_tokens(m, image_tokens) for m in system)
+            sizes = [sum(estimate_message_tokens(m, image_tokens) for m in exchange) for exchange in exchanges]
+            while len(exchanges) > 1 and sum(sizes) > budget:
+                dropped = exchanges.pop(0)
+                pruned_tokens += sizes.pop(0)
+                pruned_images += sum(count_images(m) for m in dropped)
+
+        return system + [m for exchange in exchanges for m in exchange], pruned_images, pruned_tokens
+
+    def _without_images(self, exchange: list) -> Tuple[list, int]:
+        messages, count = [], 0
+        for m in exchange:
+            if type(m["content"]) != list or count_images(m) == 0:
+                messages.append(m)
+                continue
+            content = [c for c in m["content"] if c["type"] != "image_url"]
+            images = len(m["content"]) - len(content)
+            if self.image_placeholder:
+                content.append({"type": "text", "text": f"({images} image{'s' if images > 1 else ''} shown earlier, no longer attached)"})
+            messages.append({"role": m["role"], "content": content})
+            count += images
+        return messages, count
+
+    def cache_breakpoints(self, messages: list, follow_ups: list) -> List[int]:
+        # indices (into messages without the system prompt) whose last content block gets a breakpoint
+        if not self.cache_prefix or not messages:
+            return []
+        starts = exchange_starts(messages, follow_ups)
+        return sorted(set(([starts[-1]] if starts else []) + [len(messages) - 1]))
+
+def is_follow_up(message: dict, follow_ups: list) -> bool:
+    # by identity, equal follow up texts in different exchanges are different turns
+    return any(message is follow_up for follow_up in follow_ups)
+
+def exchange_starts(messages: list, follow_ups: list) -> List[int]:
+    return [i for i, m in enumerate(messages) if m["role"] == "user" and not is_follow_up(m, follow_ups)]
+
+def split_exchanges(messages: list, follow_ups: list) -> List[list]:
+    exchanges = []
+    for m in messages:
+        if not exchanges or (m["role"] == "user" and not is_follow_up(m, follow_ups)):
+            exchanges.append([])
+        exchanges[-1].append(m)
+    return exchanges
+
+def count_images(message: dict) -> int:
+    if type(message["content"]) != list:
+        return 0
+    return sum(1 for c in message["content"] if c["type"] == "image_url")
+
+def estimate_message_tokens(message: dict, image_tokens: int) -> int:
+    if type(message["content"]) != list:
+        return estimate_text_tokens(message["content"] or "")
+    return sum(estimate_text_tokens(c["text"]) if c["type"] == "text" else image_tokens for c in message["content"])
@@ -1,66 +1,215 @@
+import asyncio
+import os
 import random
-import base64
+import time
+import weakref
 import httpx
 import yaml
-from typing import Callable, List, Tuple, Optional
-from openai import OpenAI
-from anthropic import Anthropic
+from typing import AsyncIterator, Callable, List, Tuple, Optional, Union
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient as OpenAIAsyncHttpClient
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient as AnthropicAsyncHttpClient
 from dotenv import load_dotenv
-from functools import lru_cache
+
+import cassette
+import image_store
+from api.context_window import ContextPolicy, estimate_message_tokens
+from api.image_preparation import ImagePreparer
+from api.response_cache import ResponseCache
+from api.streaming import PENDING, ACCEPT, REJECT, StreamValidator
+from api.usage import LLMUsage, llm_usage, current_usage, estimate_cost, estimate_image_tokens, estimate_text_tokens
+from background_loop import run_coroutine
+from recorder import YamlDumper, YamlSafeLoader
+from tracing import span, traced
 
 load_dotenv()
 
-openai_client = OpenAI()
-anthropic_client = Anthropic()
+http_limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+
+# httpx connection pools are bound to the event loop they are first used on, so the provider
+# clients (each with their own keep-alive pool) are kept per loop; images go through image_store
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_async_clients() -> Tuple[AsyncOpenAI, AsyncAnthropic]:
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = (
+            AsyncOpenAI(http_client=OpenAIAsyncHttpClient(limits=http_limits)),
+            AsyncAnthropic(http_client=AnthropicAsyncHttpClient(limits=http_limits))
+        )
+    return _async_clients[loop]
+
+# opt-in persistent cache of assistant responses, shared by all conversations with use_cache=True
+response_cache: Optional[ResponseCache] = None
+
+def enable_response_cache(path: str, max_bytes: int = 256 * 1024 * 1024, ttl: Optional[float] = 30 * 24 * 3600) -> ResponseCache:
+    global response_cache
+    if response_cache is None or response_cache.path != path:
+        response_cache = ResponseCache(path, max_bytes=max_bytes, ttl=ttl)
+    return response_cache
+
+def disable_response_cache():
+    global response_cache
+    if response_cache is not None:
+        response_cache.close()
+    response_cache = None
+
+# images are downscaled and re-encoded once, then inlined into requests to both providers; with
+# preparation disabled openai gets the raw urls and anthropic the bytes as fetched
+image_preparer: Optional[ImagePreparer] = ImagePreparer()
+
+def configure_image_preparation(max_edge: Optional[int] = 768, image_format: str = "JPEG", quality: int = 80) -> ImagePreparer:
+    global image_preparer
+    image_preparer = ImagePreparer(max_edge=max_edge, image_format=image_format, quality=quality)
+    return image_preparer
+
+def disable_image_preparation():
+    global image_preparer
+    image_preparer = None
+
+# what part of the transcript is sent, for conversations created without a policy of their own
+default_context_policy: Optional[ContextPolicy] = None
+
+def configure_context_window(image_exchanges: Optional[int] = None, image_placeholder: bool = True, max_history_tokens: Optional[int] = None, cache_prefix: bool = False) -> ContextPolicy:
+    global default_context_policy
+    default_context_policy = ContextPolicy(image_exchanges=image_exchanges, image_placeholder=image_placeholder, max_history_tokens=max_history_tokens, cache_prefix=cache_prefix)
+    return default_context_policy
 
 class Conversation:
-    def __init__(self, model: str = "gpt-4o", api: str = "openai", log_convo: bool = True, instruction: Optional[str] = None):
+    def __init__(self, model: str = "gpt-4o", api: str = "openai", log_convo: bool = True, instruction: Optional[str] = None, use_cache: bool = True, context_policy: Optional[ContextPolicy] = None):
         assert api in ["openai", "anthropic"]
         self.model = model
         self.api = api
+        self.use_cache = use_cache
+        self.context_policy = context_policy
         self.transcript = [{"role": "system", "content": instruction}] if instruction else []
+        self.follow_ups = [] # user turns that retry the exchange before them rather than start a new one
         self.log_convo = log_convo
+        self.logged_turns = {} # file path -> (turns written, last turn written)
+        self.usage = LLMUsage(parent=current_usage.get() or llm_usage)
         self.color_code = f"\033[38;2;{random.randint(0, 255)};{random.randint(0, 255)};{random.randint(0, 255)}m"
 
     @staticmethod
     def conversation_from_transcript(transcript: list, **kwargs) -> "Conversation":
         c = Conversation(**kwargs)
         c.transcript = transcript
+        return c
 
     @staticmethod
     def conversation_from_file(transcript_path: str, **kwargs) -> "Conversation":
         with open(transcript_path, "r") as file:
-            data = yaml.safe_load(file)
+            data = yaml.load(file, Loader=YamlSafeLoader)
         return Conversation.conversation_from_transcript(transcript=data, **kwargs)
 
     @staticmethod
-    def _get_image_data(url: str) -> Optional[Tuple[str, str]]:
-        @lru_cache(maxsize=100)
-        def cached_get_image_data(url: str) -> Optional[Tuple[str, str]]:
-            try:
-                response = httpx.get(url)
-                response.raise_for_status()
-                image_data = base64.b64encode(response.content).decode("utf-8")
-                content_type = response.headers.get('Content-Type', '')
-                return image_data, content_type
-            except httpx.HTTPError as e:
-                print(f"HTTP error occurred while fetching image: {e}")
-                return None
-            except Exception as e:
-                print(f"An error occurred while fetching image: {e}")
-                return None
-
-        result = cached_get_image_data(url)
-        if result is None:
-            cached_get_image_data.cache_clear()
-        return result
+    async def _aget_image_data(url: str) -> Optional[Tuple[str, str]]:
+        image = await image_store.aget_image(url)
+        if image is None:
+            return None
+        if image_preparer is not None:
+            return await asyncio.to_thread(image_preparer.prepare, image)
+        return image.base64, image.content_type
+
+    def _record_usage(self, **counts):
+        self.usage.record(self.model, **counts)
+
+    def _drop_turn(self, turn: dict):
+        # takes back a user turn that got no answer
+        self.transcript = [m for m in self.transcript if m is not turn]
+        self.follow_ups = [f for f in self.follow_ups if f is not turn]
+
+    def _context_policy(self) -> Optional[ContextPolicy]:
+        return self.context_policy or default_context_policy
+
+    def _context(self) -> Tuple[list, int, int]:
+        # the messages to send under the context policy, with the images and estimated tokens left out
+        policy = self._context_policy()
+        if policy is None:
+            return self.transcript, 0, 0
+        return policy.view(self.transcript, self.follow_ups, estimate_image_tokens(self.api, None))
+
+    async def _aimage_tokens(self, transcript: list) -> Tuple[int, int]:
+        # number of images in the transcript and an estimate of their input tokens at the size sent
+        image_urls = [
+            c["image_url"]["url"]
+            for m in transcript if type(m["content"]) == list
+            for c in m["content"] if c["type"] == "image_url"
+        ]
+        images = [image for image in await asyncio.gather(*[image_store.aget_image(url) for url in dict.fromkeys(image_urls)]) if image is not None]
+        if image_preparer is not None:
+            # the size is known once an image is prepared, which the request would otherwise only do
+            # after this estimate (and never for a replayed answer); prepared payloads are reused
+            unprepared = [image for image in images if image_preparer.size_of(image.sha256) is None]
+            await asyncio.gather(*[asyncio.to_thread(image_preparer.prepare, image) for image in unprepared])
+        sizes = {
+            image.url: image_preparer.size_of(image.sha256) if image_preparer is not None else None
+            for image in images
+        }
+        return len(image_urls), sum(estimate_image_tokens(self.api, sizes.get(url)) for url in image_urls)
 
-    def _get_anthropic_transcript(self) -> Tuple[list, Optional[str]]:
-        system_message = next((msg['content'] for msg in self.transcript if msg['role'] == 'system'), None)
+    async def _acache_key(self, transcript: list, json_response: bool = False) -> str:
+        # image urls are replaced by a hash of their content so the key follows what the model actually sees
+        image_urls = list(dict.fromkeys(
+            c["image_url"]["url"]
+            for m in transcript if type(m["content"]) == list
+            for c in m["content"] if c["type"] == "image_url"
+        ))
+        images = await asyncio.gather(*[image_store.aget_image(url) for url in image_urls])
+        image_hashes = {url: image.sha256 if image else url for url, image in zip(image_urls, images)}
+        
+        hashed_transcript = []
+        for m in transcript:
+            if type(m["content"]) == list:
+                content = [
+                    {"type": "image", "sha256": image_hashes[c["image_url"]["url"]]} if c["type"] == "image_url" else c
+                    for c in m["content"]
+                ]
+                hashed_transcript.append({"role": m["role"], "content": content})
+            else:
+                hashed_transcript.append(m)
+        options = {}
+        if json_response:
+            options["json_response"] = True
+        if image_urls and image_preparer is not None:
+            options["image_preparation"] = image_preparer.settings
+        return ResponseCache.key_for(self.api, self.model, hashed_transcript, **options)
+
+    @traced("llm_prepare_transcript", "llm")
+    async def _aget_openai_transcript(self, transcript: list) -> list:
+        if image_preparer is None:
+            return transcript
+        
+        image_urls = list(dict.fromkeys(
+            c["image_url"]["url"]
+            for m in transcript if type(m["content"]) == list
+            for c in m["content"] if c["type"] == "image_url"
+        ))
+        image_data = dict(zip(image_urls, await asyncio.gather(*[Conversation._aget_image_data(url) for url in image_urls])))
+        
+        def inline(c: dict) -> dict:
+            if c["type"] != "image_url" or image_data[c["image_url"]["url"]] is None:
+                return c # images that could not be fetched here are left for openai to fetch
+            data, content_type = image_data[c["image_url"]["url"]]
+            return {"type": "image_url", "image_url": {"url": f"data:{content_type};base64,{data}"}}
+        
+        return [
+            {"role": m["role"], "content": [inline(c) for c in m["content"]]} if type(m["content"]) == list else m
+            for m in transcript
+        ]
+
+    @traced("llm_prepare_transcript", "llm")
+    async def _aget_anthropic_transcript(self, transcript: list, policy: Optional[ContextPolicy] = None) -> Tuple[list, Optional[Union[str, list]]]:
+        system_message = next((msg['content'] for msg in transcript if msg['role'] == 'system'), None)
                 
-        messages = [msg for msg in self.transcript if msg['role'] != 'system']
+        messages = [msg for msg in transcript if msg['role'] != 'system']
         anthropic_messages = []
         
+        image_urls = list(dict.fromkeys(
+            c["image_url"]["url"]
+            for m in messages if type(m["content"]) == list
+            for c in m["content"] if c["type"] == "image_url"
+        ))
+        image_data = dict(zip(image_urls, await asyncio.gather(*[Conversation._aget_image_data(url) for url in image_urls])))
+        
         for m in messages:
             assert type(m["content"]) in [str, list]
             if type(m["content"]) == str:
@@ -78,7 +227,7 @@ class Conversation:
                             "type": "text",
                             "text": f"Image {image_count}:"
                         })
-                        data, content_type = Conversation._get_image_data(c["image_url"]["url"])
+                        data, content_type = image_data[c["image_url"]["url"]]
                         new_c.append({
                             "type": "image",
                             "source": {
@@ -91,50 +240,272 @@ class Conversation:
                 new_m = {"role" : m["role"], "content": new_c}
                 anthropic_messages.append(new_m)
         
+        if policy is not None and policy.cache_prefix:
+            # breakpoints go on the last block of a message, string contents are turned into a block first
+            for i in policy.cache_breakpoints(messages, self.follow_ups):
+                content = anthropic_messages[i]["content"]
+                blocks = [{"type": "text", "text": content}] if type(content) == str else [dict(c) for c in content]
+                blocks[-1]["cache_control"] = {"type": "ephemeral"}
+                anthropic_messages[i] = {"role": anthropic_messages[i]["role"], "content": blocks}
+            if system_message is not None:
+                system_message = [{"type": "text", "text": system_message, "cache_control": {"type": "ephemeral"}}]
+        
         return anthropic_messages, system_message
 
-    def message(self, message: str, images_urls: Optional[List[str]] = None) -> Optional[str]:
-        if self.log_convo:
-            print(f"{self.color_code}USER:\n{message}\n(images attachments - {images_urls})\033[0m")
-            
-        if images_urls:
-            content = [{"type": "text", "text": message}] + [
-                {"type": "image_url", "image_url": {"url": url}}
-                for url in images_urls
-            ]
-        else:
-            content = message
-        self.transcript.append({"role": "user", "content": content})
-        
-        try:
-            if self.api == "openai":
-                response = openai_client.chat.completions.create(
+    async def _acomplete(self, transcript: list, json_response: bool) -> dict:
+        # one provider call for the transcript; the answer, token counts (input tokens include prompt
+        # cache reads and writes) and latency
+        openai_client, anthropic_client = get_async_clients()
+        if self.api == "openai":
+            messages = await self._aget_openai_transcript(transcript)
+            start = time.perf_counter()
+            with span("llm_provider_call", "llm", api=self.api, model=self.model):
+                response = await openai_client.chat.completions.create(
                     model=self.model,
-                    messages=self.transcript
+                    messages=messages,
+                    **({"response_format": {"type": "json_object"}} if json_response else {})
                 )
-                result = response.choices[0].message.content 
-            elif self.api == "anthropic":
-                messages, system_message = self._get_anthropic_transcript()
+            latency = time.perf_counter() - start
+            usage = response.usage
+            details = getattr(usage, "prompt_tokens_details", None) if usage else None
+            return {
+                "text": response.choices[0].message.content,
+                "input_tokens": usage.prompt_tokens if usage else 0,
+                "output_tokens": usage.completion_tokens if usage else 0,
+                "cache_read_tokens": (details.cached_tokens or 0) if details else 0,
+                "cache_write_tokens": 0,
+                "latency_seconds": latency,
+            }
+        elif self.api == "anthropic":
+            messages, system_message = await self._aget_anthropic_transcript(transcript, self._context_policy())
+            start = time.perf_counter()
+            with span("llm_provider_call", "llm", api=self.api, model=self.model):
                 if system_message is not None:
-                    response = anthropic_client.messages.create(
+                    response = await anthropic_client.messages.create(
                         max_tokens=4096,
                         model=self.model,
                         messages=messages,
                         system=system_message
                     )
                 else:
-                    response = anthropic_client.messages.create(
+                    response = await anthropic_client.messages.create(
                         max_tokens=4096,
                         model=self.model,
                         messages=messages
                     )
-                result = response.content[0].text    
+            latency = time.perf_counter() - start
+            cache_read_tokens = getattr(response.usage, "cache_read_input_tokens", None) or 0
+            cache_write_tokens = getattr(response.usage, "cache_creation_input_tokens", None) or 0
+            return {
+                "text": response.content[0].text,
+                "input_tokens": response.usage.input_tokens + cache_read_tokens + cache_write_tokens,
+                "output_tokens": response.usage.output_tokens,
+                "cache_read_tokens": cache_read_tokens,
+                "cache_write_tokens": cache_write_tokens,
+                "latency_seconds": latency,
+            }
+        raise ValueError(f"unsupported api {self.api}")
+
+    async def _astream(self, transcript: list, json_response: bool, usage: dict) -> AsyncIterator[str]:
+        # text deltas of one streamed provider call, token counts are filled into usage as the provider
+        # reports them; closing the generator early closes the response
+        openai_client, anthropic_client = get_async_clients()
+        if self.api == "openai":
+            messages = await self._aget_openai_transcript(transcript)
+            stream = await openai_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **({"response_format": {"type": "json_object"}} if json_response else {})
+            )
+            try:
+                async for chunk in stream:
+                    if chunk.usage:
+                        details = getattr(chunk.usage, "prompt_tokens_details", None)
+                        usage.update(
+                            input_tokens=chunk.usage.prompt_tokens,
+                            output_tokens=chunk.usage.completion_tokens,
+                            cache_read_tokens=(details.cached_tokens or 0) if details else 0
+                        )
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+        elif self.api == "anthropic":
+            messages, system_message = await self._aget_anthropic_transcript(transcript, self._context_policy())
+            async with anthropic_client.messages.stream(
+                max_tokens=4096,
+                model=self.model,
+                messages=messages,
+                **({"system": system_message} if system_message is not None else {})
+            ) as stream:
+                try:
+                    async for text in stream.text_stream:
+                        yield text
+                finally:
+                    # input tokens arrive with the first event, output tokens count up to the last one read
+                    try:
+                        snapshot = stream.current_message_snapshot.usage
+                    except Exception:
+                        snapshot = None
+                    if snapshot is not None:
+                        cache_read_tokens = getattr(snapshot, "cache_read_input_tokens", None) or 0
+                        cache_write_tokens = getattr(snapshot, "cache_creation_input_tokens", None) or 0
+                        usage.update(
+                            input_tokens=snapshot.input_tokens + cache_read_tokens + cache_write_tokens,
+                            output_tokens=snapshot.output_tokens,
+                            cache_read_tokens=cache_read_tokens,
+                            cache_write_tokens=cache_write_tokens
+                        )
+        else:
+            raise ValueError(f"unsupported api {self.api}")
+
+    async def _acomplete_stream(self, transcript: list, json_response: bool, validator: Optional[StreamValidator], on_text: Optional[Callable[[str], None]]) -> dict:
+        # like _acomplete, but reads the answer as it is generated; the validator can stop the stream
+        # as soon as it accepts (the answer is then the accepted part) or rejects what arrived so far
+        usage = {"input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0}
+        text, decision, answer = "", PENDING, None
+        start = time.perf_counter()
+        with span("llm_provider_call", "llm", api=self.api, model=self.model, stream=True):
+            stream = self._astream(transcript, json_response, usage)
+            try:
+                async for piece in stream:
+                    text += piece
+                    if on_text is not None:
+                        on_text(piece)
+                    if validator is not None:
+                        decision, answer = validator.check(text)
+                        if decision != PENDING:
+                            break
+            finally:
+                await stream.aclose()
+        latency = time.perf_counter() - start
+        
+        # openai only reports usage at the end of a stream, a stream cut short is estimated
+        if not usage["input_tokens"]:
+            usage["input_tokens"] = sum(estimate_message_tokens(m, estimate_image_tokens(self.api, None)) for m in transcript)
+        if not usage["output_tokens"]:
+            usage["output_tokens"] = estimate_text_tokens(text)
+        return dict(
+            usage,
+            text=answer if decision == ACCEPT else text,
+            latency_seconds=latency,
+            early_stop=decision if decision != PENDING else None
+        )
+
+    def message(self, message: str, images_urls: Optional[List[str]] = None, json_response: bool = False, follow_up: bool = False, validator: Optional[StreamValidator] = None) -> Optional[str]:
+        return run_coroutine(self.amessage(message, images_urls, json_response, follow_up, validator=validator))
+
+    async def astream(self, message: str, images_urls: Optional[List[str]] = None, json_response: bool = False, follow_up: bool = False) -> AsyncIterator[str]:
+        # yields the answer in pieces as they arrive, the turn is recorded as with amessage; a reader
+        # that stops early cancels the request and leaves the transcript as it was
+        pieces = asyncio.Queue()
+        reply = asyncio.ensure_future(self.amessage(message, images_urls, json_response, follow_up, stream=True, on_text=pieces.put_nowait))
+        reply.add_done_callback(lambda _: pieces.put_nowait(None))
+        try:
+            while (piece := await pieces.get()) is not None:
+                yield piece
+        finally:
+            if not reply.done():
+                reply.cancel()
+
+    # json_response asks openai for a json object (the message must mention json); anthropic has no
+    # json mode, so there the instructions in the message have to carry it. follow_up marks a message
+    # that continues the previous exchange (a retry), which the context policy keeps together.
+    # stream reads the answer as it is generated, passing each piece to on_text; with a validator the
+    # answer is streamed and cut off as soon as the validator accepts or rejects it
+    @traced("llm_message", "llm")
+    async def amessage(
+        self,
+        message: str,
+        images_urls: Optional[List[str]] = None,
+        json_response: bool = False,
+        follow_up: bool = False,
+        stream: bool = False,
+        validator: Optional[StreamValidator] = None,
+        on_text: Optional[Callable[[str], None]] = None
+    ) -> Optional[str]:
+        if self.log_convo:
+            print(f"{self.color_code}USER:\n{message}\n(images attachments - {images_urls})\033[0m")
+            
+        if images_urls:
+            content = [{"type": "text", "text": message}] + [
+                {"type": "image_url", "image_url": {"url": url}}
+                for url in images_urls
+            ]
+        else:
+            content = message
+        turn = {"role": "user", "content": content}
+        self.transcript.append(turn)
+        if follow_up:
+            self.follow_ups.append(turn)
+        transcript, pruned_images, pruned_tokens = self._context()
+        
+        cache = response_cache if self.use_cache else None
+        with span("llm_cache_lookup", "llm"):
+            cache_key = await self._acache_key(transcript, json_response) if cache is not None else None
+            cached = cache.get(cache_key) if cache is not None else None
+        if cached is not None:
+            self._record_usage(cached=1)
+            if on_text is not None:
+                on_text(cached)
+            self.transcript.append({"role": "assistant", "content": cached})
+            if self.log_convo:
+                print(f"{self.color_code}ASSISTANT (cached):\n{cached}\033[0m")
+            return cached
+        
+        streamed = []
+        def on_piece(piece: str):
+            streamed.append(piece)
+            if on_text is not None:
+                on_text(piece)
+        
+        if stream or validator is not None:
+            complete = lambda: self._acomplete_stream(transcript, json_response, validator, on_piece)
+        else:
+            complete = lambda: self._acomplete(transcript, json_response)
+        try:
+            images_sent, image_tokens = await self._aimage_tokens(transcript)
+            if cassette.cassette is None:
+                completion = await complete()
+            else:
+                # recorded or replayed per request, keyed like the response cache
+                request = {"key": cache_key or await self._acache_key(transcript, json_response)}
+                if validator is not None:
+                    request["validator"] = repr(validator)
+                completion = await cassette.acall("llm", request, complete, errors=(Exception,))
+        except asyncio.CancelledError:
+            self._drop_turn(turn)
+            raise
         except Exception as e:
-            self.transcript = self.transcript[:-1]
+            self._drop_turn(turn)
+            self._record_usage(failures=1)
             print(f"An error occurred during conversation: {e}")
             return None
         
+        if on_text is not None and not streamed:
+            on_text(completion["text"]) # a replayed answer arrives in one piece
+        
+        result = completion["text"]
+        self._record_usage(
+            requests=1,
+            images_sent=images_sent,
+            input_tokens=completion["input_tokens"],
+            output_tokens=completion["output_tokens"],
+            image_tokens=image_tokens,
+            cache_read_tokens=completion["cache_read_tokens"],
+            cache_write_tokens=completion["cache_write_tokens"],
+            pruned_images=pruned_images,
+            pruned_tokens=pruned_tokens,
+            early_accepts=int(completion.get("early_stop") == ACCEPT),
+            early_rejects=int(completion.get("early_stop") == REJECT),
+            latency_seconds=completion["latency_seconds"],
+            cost_usd=estimate_cost(self.model, completion["input_tokens"], completion["output_tokens"], completion["cache_read_tokens"], completion["cache_write_tokens"])
+        )
         self.transcript.append({"role": "assistant", "content": result})
+        if cache is not None and result is not None and completion.get("early_stop") != REJECT:
+            cache.put(cache_key, result)
         
         if self.log_convo:
             print(f"{self.color_code}ASSISTANT:\n{result}\033[0m")
@@ -147,20 +518,47 @@ class Conversation:
         valid_criteria: str,
         message: str,
         images_urls: Optional[List[str]] = None,
-        max_retries: int = 3
+        max_retries: int = 3,
+        json_response: bool = False,
+        validator: Optional[StreamValidator] = None
+    ) -> Optional[str]:
+        return run_coroutine(self.amessage_until_response_valid(valid, valid_criteria, message, images_urls, max_retries, json_response, validator))
+    
+    @traced("llm_until_valid", "llm")
+    async def amessage_until_response_valid(
+        self,
+        valid: Callable[[str], bool],
+        valid_criteria: str,
+        message: str,
+        images_urls: Optional[List[str]] = None,
+        max_retries: int = 3,
+        json_response: bool = False,
+        validator: Optional[StreamValidator] = None
     ) -> Optional[str]:
-        result = self.message(f"{message}\nanswer should meet criteria - {valid_criteria}", images_urls)
+        # a validator (see api.streaming) streams each answer and decides on it early, valid still
+        # has the final say on what the validator accepted
+        result = await self.amessage(f"{message}\nanswer should meet criteria - {valid_criteria}", images_urls, json_response, validator=validator)
         
         if result is not None and valid(result):
             return result
         
         for _ in range(max_retries):
-            result = self.message(f"answer did not meet criteria - {valid_criteria}; answer again")
+            self._record_usage(retries=1)
+            result = await self.amessage(f"answer did not meet criteria - {valid_criteria}; answer again", json_response=json_response, follow_up=True, validator=validator)
             if result is not None and valid(result):
                 return result
         
         return None
     
     def log_conversation(self, file_path: str):
-        with open(file_path, "w", encoding="utf-8") as file:
-            yaml.dump(self.transcript, file, allow_unicode=True)
\ No newline at end of file
+        # yaml sequences concatenate, so when the logged turns are still a prefix of the transcript
+        # only the new turns are appended instead of rewriting the whole file
+        written, last_turn = self.logged_turns.get(file_path, (0, None))
+        unchanged = 0 < written <= len(self.transcript) and self.transcript[written - 1] is last_turn
+        append = unchanged and os.path.exists(file_path)
+        new_turns = self.transcript[written:] if append else self.transcript
+        with open(file_path, "a" if append else "w", encoding="utf-8") as file:
+            if new_turns:
+                yaml.dump(new_turns, file, allow_unicode=True, Dumper=YamlDumper)
+        if self.transcript:
+            self.logged_turns[file_path] = (len(self.transcript), self.transcript[-1])
\ No newline at end of file
@@ -0,0 +1,96 @@
+import base64
+import io
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps
+
+from image_store import StoredImage
+
+# media types both providers accept inline, used when an image is sent as fetched
+inline_media_types = ["image/jpeg", "image/png", "image/gif", "image/webp"]
+
+class ImagePreparer:
+    # downscales images to max_edge and re-encodes them (JPEG or WEBP) before they are inlined into
+    # llm requests; results are kept per content hash so retries and later turns reuse them
+    def __init__(self, max_edge: Optional[int] = 768, image_format: str = "JPEG", quality: int = 80, max_bytes: int = 64 * 1024 * 1024):
+        assert image_format in ["JPEG", "WEBP"], "image_format should be JPEG or WEBP"
+        self.max_edge = max_edge
+        self.image_format = image_format
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.prepared, self.passthrough, self.original_bytes, self.prepared_bytes = 0, 0, 0, 0
+        self._payloads = OrderedDict() # content sha256 -> (base64 data, media type)
+        self._sizes = {} # content sha256 -> (width, height) as sent
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def settings(self) -> dict:
+        return {"max_edge": self.max_edge, "image_format": self.image_format, "quality": self.quality}
+
+    def prepare(self, image: StoredImage) -> Tuple[str, str]:
+        with self._lock:
+            if image.sha256 in self._payloads:
+                self._payloads.move_to_end(image.sha256)
+                return self._payloads[image.sha256]
+
+        data, media_type = self._transcode(image)
+        payload = (base64.b64encode(data).decode("utf-8"), media_type)
+        with self._lock:
+            self.original_bytes += len(image.data)
+            self.prepared_bytes += len(data)
+            self._payloads[image.sha256] = payload
+            self._size += len(payload[0])
+            while self._size > self.max_bytes and len(self._payloads) > 1:
+                _, (evicted, _) = self._payloads.popitem(last=False)
+                self._size -= len(evicted)
+        return payload
+
+    def _transcode(self, image: StoredImage) -> Tuple[bytes, str]:
+        try:
+            with Image.open(io.BytesIO(image.data)) as source:
+                source.load()
+                resized = self.max_edge is not None and max(source.size) > self.max_edge
+                picture = ImageOps.exif_transpose(source)
+                if picture.mode not in ("RGB", "L"):
+                    # flatten transparency onto white, as thumbnails are shown on white pages
+                    background = Image.new("RGB", picture.size, "white")
+                    background.paste(picture.convert("RGBA"), mask=picture.convert("RGBA").split()[-1])
+                    picture = background
+                if resized:
+                    picture.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+                with self._lock:
+                    self._sizes[image.sha256] = picture.size
+                output = io.BytesIO()
+                picture.save(output, self.image_format, quality=self.quality)
+        except Exception as e:
+            print(f"[image_preparation] could not transcode image {image.url}, sending it as fetched: {e}")
+            return self._passthrough(image)
+
+        # a small image that was already compressed well is better left alone
+        if not resized and len(output.getvalue()) >= len(image.data) and image.content_type in inline_media_types:
+            return self._passthrough(image)
+        with self._lock:
+            self.prepared += 1
+        return output.getvalue(), f"image/{self.image_format.lower()}"
+
+    def size_of(self, sha256: str) -> Optional[Tuple[int, int]]:
+        with self._lock:
+            return self._sizes.get(sha256)
+
+    def _passthrough(self, image: StoredImage) -> Tuple[bytes, str]:
+        with self._lock:
+            self.passthrough += 1
+        return image.data, image.content_type
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "prepared": self.prepared,
+                "passthrough": self.passthrough,
+                "original_bytes": self.original_bytes,
+                "prepared_bytes": self.prepared_bytes,
+                "saved_rate": 1 - self.prepared_bytes / self.original_bytes if self.original_bytes else 0.0,
+            }
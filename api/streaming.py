@@ -0,0 +1,101 @@
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+
+# validators that judge a streamed answer while it arrives, so a short structured answer can be
+# taken as soon as it is complete and an answer that has gone off format is cut off and retried
+# without waiting for the rest of it; the caller's own predicate still has the final say
+
+PENDING = "pending"
+ACCEPT = "accept"
+REJECT = "reject"
+
+class StreamValidator(ABC):
+    @abstractmethod
+    def check(self, partial: str) -> Tuple[str, Optional[str]]:
+        # (ACCEPT, answer) once the answer is complete, (REJECT, None) once no continuation of
+        # partial can be valid, (PENDING, None) otherwise
+        ...
+
+class YesNoValidator(StreamValidator):
+    # accepts "yes" / "no" in any case, along with anything after it once a non letter follows
+    # (the "yes." or "no, because" that a strict comparison would send back for a retry)
+    answers = ["yes", "no"]
+
+    def check(self, partial: str) -> Tuple[str, Optional[str]]:
+        text = partial.lstrip().lower()
+        for answer in self.answers:
+            if text.startswith(answer) and len(text) > len(answer) and not text[len(answer)].isalpha():
+                return ACCEPT, answer
+        if any(answer.startswith(text) for answer in self.answers):
+            return PENDING, None
+        return REJECT, None
+
+    def __repr__(self) -> str:
+        return "YesNoValidator()"
+
+class ListValidator(StreamValidator):
+    # a python (or json) list literal of exactly length bools or strings, as checked by
+    # analyst.is_valid_list_of; accepted at its closing bracket, so trailing talk is dropped
+    def __init__(self, item_type: type, length: int, syntax: str = "python"):
+        assert item_type in [bool, str], "item_type should be bool or str"
+        assert syntax in ["python", "json"], "syntax should be python or json"
+        self.item_type = item_type
+        self.length = length
+        self.syntax = syntax
+        self.quotes = ['"'] if syntax == "json" else ['"', "'"]
+        self.literals = ["true", "false"] if syntax == "json" else ["True", "False"]
+
+    def check(self, partial: str) -> Tuple[str, Optional[str]]:
+        start = len(partial) - len(partial.lstrip())
+        if start == len(partial):
+            return PENDING, None
+        if partial[start] != "[":
+            return REJECT, None
+
+        items, expecting_item, trailing_comma = 0, True, False
+        quote, escaped, word = None, False, ""
+        for i in range(start + 1, len(partial)):
+            ch = partial[i]
+            if quote is not None:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == quote:
+                    quote = None
+                continue
+            if word and not ch.isalpha():
+                if word not in self.literals:
+                    return REJECT, None
+                word = ""
+            if ch.isspace():
+                continue
+            if ch == "]":
+                if items != self.length or (trailing_comma and self.syntax == "json"):
+                    return REJECT, None
+                return ACCEPT, partial[start:i + 1]
+            if expecting_item:
+                if items == self.length:
+                    return REJECT, None
+                if self.item_type is str and ch in self.quotes:
+                    quote = ch
+                elif self.item_type is bool and any(literal.startswith(ch) for literal in self.literals):
+                    word = ch
+                else:
+                    return REJECT, None
+                items += 1
+                expecting_item, trailing_comma = False, False
+                continue
+            if word:
+                word += ch
+                if not any(literal.startswith(word) for literal in self.literals):
+                    return REJECT, None
+                continue
+            if ch == ",":
+                expecting_item, trailing_comma = True, True
+                continue
+            return REJECT, None
+        return PENDING, None
+
+    def __repr__(self) -> str:
+        return f"ListValidator({self.item_type.__name__}, {self.length}, syntax={self.syntax!r})"
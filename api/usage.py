@@ -0,0 +1,135 @@
+import contextvars
+import math
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# usd per million input / output tokens, matched by the longest model name prefix
+model_prices = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4-turbo": (10.00, 30.00),
+    "claude-3-5-sonnet": (3.00, 15.00),
+    "claude-3-5-haiku": (0.80, 4.00),
+    "claude-3-opus": (15.00, 75.00),
+    "claude-3-haiku": (0.25, 1.25),
+}
+
+# prompt cache reads and writes as a share of the input price; openai writes are not charged extra
+cache_price_factors = {
+    "gpt-": (0.5, 1.0),
+    "claude-": (0.1, 1.25),
+}
+
+def price_of(model: str) -> Optional[Tuple[float, float]]:
+    prefix = max((prefix for prefix in model_prices if model.startswith(prefix)), key=len, default=None)
+    return model_prices[prefix] if prefix else None
+
+def estimate_cost(model: str, input_tokens: int, output_tokens: int, cache_read_tokens: int = 0, cache_write_tokens: int = 0) -> float:
+    # input_tokens include the cache reads and writes, which are then charged at their own rate
+    price = price_of(model)
+    if price is None:
+        return 0.0
+    read_factor, write_factor = next((factors for prefix, factors in cache_price_factors.items() if model.startswith(prefix)), (1.0, 1.0))
+    uncached_tokens = input_tokens - cache_read_tokens - cache_write_tokens
+    input_cost = (uncached_tokens + cache_read_tokens * read_factor + cache_write_tokens * write_factor) * price[0]
+    return (input_cost + output_tokens * price[1]) / 1_000_000
+
+def estimate_text_tokens(text: str) -> int:
+    # about 4 characters per token for latin text and 1 per character for chinese, i.e. ~3 utf-8 bytes
+    return len(text.encode("utf-8")) // 3 + 1
+
+def estimate_image_tokens(api: str, size: Optional[Tuple[int, int]]) -> int:
+    # provider formulas; openai tiles the image in 512px squares after fitting it in 2048 and
+    # scaling the short side to 768, anthropic charges about one token per 750 pixels
+    if size is None:
+        return 765 if api == "openai" else 1600
+    width, height = size
+    if api == "openai":
+        scale = min(1, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1, 768 / min(width, height))
+        width, height = width * scale, height * scale
+        return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+    scale = min(1, 1568 / max(width, height))
+    return math.ceil(width * scale * height * scale / 750)
+
+counters = [
+    # name, help
+    ("requests", "calls answered by a provider"),
+    ("cached", "calls answered from the response cache"),
+    ("failures", "calls that raised"),
+    ("retries", "follow up messages sent because an answer did not meet its criteria"),
+    ("early_accepts", "streamed answers taken as soon as their validator accepted them"),
+    ("early_rejects", "streamed answers cut off once their validator rejected them"),
+    ("images_sent", "images in requests, every request resends the images of the whole transcript"),
+    ("input_tokens", "input tokens reported by the provider, including prompt cache reads and writes"),
+    ("output_tokens", "output tokens reported by the provider"),
+    ("image_tokens", "estimated input tokens spent on images"),
+    ("cache_read_tokens", "input tokens read from the provider's prompt cache"),
+    ("cache_write_tokens", "input tokens written to the provider's prompt cache"),
+    ("pruned_images", "images of older exchanges left out by the context policy"),
+    ("pruned_tokens", "estimated input tokens left out by the context policy"),
+    ("latency_seconds", "wall time spent waiting on providers"),
+    ("cost_usd", "estimated cost from model_prices"),
+]
+
+class LLMUsage:
+    # counters for a conversation, a term or a run, in total and per model; records are passed on
+    # to the parent scope
+    def __init__(self, parent: Optional["LLMUsage"] = None):
+        self.parent = parent
+        self.totals = self._empty()
+        self.by_model: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _empty() -> dict:
+        return dict({name: 0 for name, _ in counters}, max_latency_seconds=0.0)
+
+    def record(self, model: str, latency_seconds: float = 0.0, **counts):
+        with self._lock:
+            for totals in [self.totals, self.by_model.setdefault(model, self._empty())]:
+                for name, count in counts.items():
+                    totals[name] += count
+                totals["latency_seconds"] += latency_seconds
+                totals["max_latency_seconds"] = max(totals["max_latency_seconds"], latency_seconds)
+        if self.parent is not None:
+            self.parent.record(model, latency_seconds, **counts)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return dict(self.totals, by_model={model: dict(totals) for model, totals in self.by_model.items()})
+
+# process-wide totals (the root of every scope), and the innermost scope conversations created in the
+# current context report to
+llm_usage = LLMUsage()
+current_usage = contextvars.ContextVar("current_llm_usage", default=None)
+
+@contextmanager
+def track_llm_usage() -> Iterator[LLMUsage]:
+    # conversations created inside the block (or in work submitted with contextvars.copy_context().run)
+    # count their calls towards the yielded usage, and through it towards any enclosing scope
+    usage = LLMUsage(parent=current_usage.get() or llm_usage)
+    token = current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        current_usage.reset(token)
+
+def prometheus_text(scopes: List[Tuple[dict, dict]]) -> str:
+    # renders (labels, usage.as_dict()) pairs in the prometheus text exposition format, one series
+    # per scope and model
+    def label_string(labels: dict) -> str:
+        escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+        return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+    lines = []
+    for name, description in counters + [("max_latency_seconds", "slowest single provider call")]:
+        metric = f"llm_{name}" if name == "max_latency_seconds" else f"llm_{name}_total"
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {'gauge' if name == 'max_latency_seconds' else 'counter'}")
+        for labels, usage in scopes:
+            for model, totals in usage["by_model"].items():
+                lines.append(f"{metric}{label_string(dict(labels, model=model))} {totals[name]}")
+    return "\n".join(lines) + "\n"
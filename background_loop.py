@@ -0,0 +1,33 @@
+import asyncio
+import contextvars
+import threading
+from typing import Any, Awaitable, Optional
+
+# a single event loop running on a daemon thread, shared by the sync wrappers of async apis
+# so that blocking callers on any thread can keep many requests in flight on one loop
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="background-loop", daemon=True).start()
+    return _loop
+
+def run_coroutine(coro: Awaitable[Any]) -> Any:
+    loop = get_background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    assert running is not loop, "run_coroutine would deadlock when called from the background loop, await the coroutine instead"
+    return asyncio.run_coroutine_threadsafe(_in_context(contextvars.copy_context(), coro), loop).result()
+
+async def _in_context(context: contextvars.Context, coro: Awaitable[Any]) -> Any:
+    # the task runs with the caller's context variables (llm usage scope, tracing span) rather than
+    # those of the loop thread
+    for var, value in context.items():
+        var.set(value)
+    return await coro
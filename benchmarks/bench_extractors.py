@@ -0,0 +1,103 @@
+import argparse
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from selectorlib import Extractor
+from scraper.compiled_extractor import CompiledExtractor
+
+# compares selectorlib against the compiled layout extractor on saved result pages
+# fixtures are html files named after their layout, e.g. fixtures/1688_results_image_search_lamps.html,
+# so corpus_output files from real runs can be dropped in next to the bundled ones
+
+layout_dir = os.path.join(os.path.dirname(__file__), "..", "scraper", "layout")
+layouts = sorted((os.path.splitext(name)[0] for name in os.listdir(layout_dir) if name.endswith(".yml")), key=len, reverse=True)
+engines = {"selectorlib": Extractor, "compiled": CompiledExtractor}
+
+def load_fixtures(fixtures_dir: str) -> list:
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, "*.html"))):
+        name = os.path.basename(path)
+        layout = next((layout for layout in layouts if name.startswith(layout)), None)
+        if layout is None:
+            print(f"[bench_extractors] skipping {name}, no layout matches its name")
+            continue
+        with open(path, "r", encoding="utf-8") as file:
+            fixtures.append((layout, name, file.read()))
+    return fixtures
+
+def run_engine(engine: str, fixtures_dir: str, seconds: float) -> dict:
+    fixtures = load_fixtures(fixtures_dir)
+    extractors = {layout: engines[engine].from_yaml_file(os.path.join(layout_dir, f"{layout}.yml")) for layout in layouts}
+
+    tracemalloc.start()
+    for layout, _, html in fixtures:
+        extractors[layout].extract(html)
+    _, peak_python_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    pages, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for layout, _, html in fixtures:
+            extractors[layout].extract(html)
+            pages += 1
+    elapsed = time.perf_counter() - start
+
+    return {
+        "engine": engine,
+        "pages": pages,
+        "pages_per_second": pages / elapsed,
+        "peak_python_bytes": peak_python_bytes,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def check_identical(fixtures_dir: str) -> list:
+    mismatches = []
+    for layout, name, html in load_fixtures(fixtures_dir):
+        path = os.path.join(layout_dir, f"{layout}.yml")
+        if Extractor.from_yaml_file(path).extract(html) != CompiledExtractor.from_yaml_file(path).extract(html):
+            mismatches.append(name)
+    return mismatches
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--fixtures", default=os.path.join(os.path.dirname(__file__), "fixtures"))
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--engine", choices=list(engines), help="run a single engine and print its result as json")
+    args = parser.parse_args()
+
+    if args.engine:
+        print(json.dumps(run_engine(args.engine, args.fixtures, args.seconds)))
+        return
+
+    fixtures = load_fixtures(args.fixtures)
+    print(f"[bench_extractors] {len(fixtures)} fixtures from {args.fixtures}")
+    mismatches = check_identical(args.fixtures)
+    print(f"[bench_extractors] outputs identical: {not mismatches} {mismatches if mismatches else ''}")
+
+    # each engine runs in a fresh interpreter so peak memory is not shared between them
+    results = []
+    for engine in engines:
+        output = subprocess.run(
+            [sys.executable, __file__, "--engine", engine, "--fixtures", args.fixtures, "--seconds", str(args.seconds)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'engine':<12} {'pages/sec':>10} {'peak py MB':>11} {'max rss MB':>11}")
+    for result in results:
+        print(f"{result['engine']:<12} {result['pages_per_second']:>10.1f} {result['peak_python_bytes'] / 2**20:>11.2f} {result['max_rss_kb'] / 1024:>11.1f}")
+    print(f"speedup: {results[1]['pages_per_second'] / results[0]['pages_per_second']:.2f}x")
+
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
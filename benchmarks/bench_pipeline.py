@@ -0,0 +1,126 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import analyst
+from cassette import Cassette, REPLAY, eject_cassette, replay_cassette
+from scraper.compiled_extractor import CompiledExtractor
+from scraper.scrape_results_page import layouts
+
+# replays a cassette recorded with search_term_exploration(..., record_to=...) through the whole
+# analyst pipeline offline and reports terms/minute, llm calls per term and extraction throughput;
+# the explored terms are compared with the recording, so a change that alters the pipeline's
+# decisions shows up as a mismatch
+#
+#   python analyst-example.py  # with record_to="cassettes/lamps"
+#   python benchmarks/bench_pipeline.py --cassette cassettes/lamps
+
+def recorded_pages(cassette: Cassette) -> list:
+    # (layout, html) of every page the recorded run extracted products from
+    pages = []
+    for kind in ["http", "page", "image_search"]:
+        for entry in cassette.entries(kind):
+            response = entry["response"]
+            html = response["text"] if kind == "http" and response is not None else response
+            if not html:
+                continue
+            if kind == "image_search":
+                layout = "1688_image_search"
+            else:
+                layout = "amazon" if "amazon." in entry["request"]["url"] else "1688"
+            pages.append((layout, html))
+    return pages
+
+def run_extraction(pages: list, seconds: float) -> dict:
+    extractors = {layout: CompiledExtractor.from_yaml_file(path) for layout, path in layouts.items()}
+    if not pages:
+        return {"pages": 0, "pages_per_second": 0.0, "mb_per_second": 0.0}
+
+    extracted, size, start = 0, 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        for layout, html in pages:
+            extractors[layout].extract(html)
+            extracted += 1
+            size += len(html)
+    elapsed = time.perf_counter() - start
+    return {"pages": extracted, "pages_per_second": extracted / elapsed, "mb_per_second": size / elapsed / 2**20}
+
+def run_pipeline(cassette_dir: str, metadata: dict, args: argparse.Namespace) -> dict:
+    # each replay runs in a scratch directory so its runs/ output does not mix with real runs
+    with tempfile.TemporaryDirectory() as scratch:
+        cwd = os.getcwd()
+        os.chdir(scratch)
+        output = io.StringIO()
+        try:
+            tape = replay_cassette(cassette_dir, replay_latency=args.replay_latency)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(output if not args.verbose else sys.stdout):
+                analyst.search_term_exploration(
+                    metadata["initial_term"],
+                    recursions=metadata["recursions"],
+                    branching_factor=metadata["branching_factor"],
+                    max_concurrency=args.max_concurrency,
+                    listing_concurrency=args.listing_concurrency
+                )
+            elapsed = time.perf_counter() - start
+            with open(os.path.join(analyst.run_dir, "checkpoint.json"), "r", encoding="utf-8") as file:
+                checkpoint = json.load(file)
+            with open(os.path.join(analyst.run_dir, "llm_usage.json"), "r", encoding="utf-8") as file:
+                usage = json.load(file)["run"]
+        finally:
+            eject_cassette()
+            os.chdir(cwd)
+
+    terms = len(checkpoint["completed"]) + len(checkpoint["failed"])
+    return {
+        "seconds": elapsed,
+        "terms": terms,
+        "terms_per_minute": terms / elapsed * 60,
+        "llm_calls_per_term": usage["requests"] / terms if terms else 0.0,
+        "llm_images_per_term": usage["images_sent"] / terms if terms else 0.0,
+        "cassette_misses": sum(tape.stats()["misses"].values()),
+        "completed": checkpoint["completed"],
+        "failed": checkpoint["failed"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cassette", required=True, help="directory recorded with search_term_exploration(..., record_to=...)")
+    parser.add_argument("--max-concurrency", type=int, default=1)
+    parser.add_argument("--listing-concurrency", type=int, default=5)
+    parser.add_argument("--replay-latency", action="store_true", help="wait as long as each recorded request took")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seconds", type=float, default=3.0, help="duration of the extraction benchmark")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    args = parser.parse_args()
+
+    cassette_dir = os.path.abspath(args.cassette)
+    cassette = Cassette(cassette_dir, REPLAY)
+    metadata = cassette.read_metadata()
+    if metadata is None:
+        sys.exit(f"[bench_pipeline] {cassette_dir} has no cassette.json, record it with search_term_exploration(..., record_to=...)")
+    print(f"[bench_pipeline] replaying {metadata['initial_term']} (recursions={metadata['recursions']}, branching_factor={metadata['branching_factor']}) from {cassette_dir}")
+
+    results = [run_pipeline(cassette_dir, metadata, args) for _ in range(args.repeat)]
+    print(f"{'run':<4} {'seconds':>8} {'terms':>6} {'terms/min':>10} {'llm calls/term':>15} {'images/term':>12} {'misses':>7}")
+    for i, result in enumerate(results):
+        print(f"{i:<4} {result['seconds']:>8.2f} {result['terms']:>6} {result['terms_per_minute']:>10.1f} {result['llm_calls_per_term']:>15.2f} {result['llm_images_per_term']:>12.1f} {result['cassette_misses']:>7}")
+
+    pages = recorded_pages(cassette)
+    extraction = run_extraction(pages, args.seconds)
+    print(f"[bench_pipeline] extraction - {len(pages)} recorded pages, {extraction['pages_per_second']:.1f} pages/sec, {extraction['mb_per_second']:.1f} MB/sec")
+
+    mismatches = [i for i, result in enumerate(results) if (result["completed"], result["failed"]) != (metadata["completed"], metadata["failed"])]
+    print(f"[bench_pipeline] explored terms match the recording: {not mismatches} {mismatches if mismatches else ''}")
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
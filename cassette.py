@@ -0,0 +1,206 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Iterator, Optional, Tuple
+
+# record / replay of everything a run fetches from the outside (amazon responses, rendered pages,
+# 1688 image searches, images and llm answers) so the pipeline can be benchmarked and regression
+# tested offline; with no cassette loaded the hooks call straight through
+#
+# entries live in <path>/<kind>/<request sha256>.<n>.json.gz, n counting repeats of the same request
+# (an llm retry or a page re-fetched after an eviction), replayed in recorded order
+
+RECORD = "record"
+REPLAY = "replay"
+
+class CassetteMiss(LookupError):
+    pass
+
+_missing = object()
+
+def _identity(value: Any) -> Any:
+    return value
+
+class Cassette:
+    def __init__(self, path: str, mode: str, replay_latency: bool = False):
+        assert mode in [RECORD, REPLAY], f"mode should be {RECORD} or {REPLAY}"
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.recorded, self.replayed, self.misses = {}, {}, {} # kind -> count
+        self._counts = {} # (kind, key) -> entries on disk
+        self._replay_positions = {} # (kind, key) -> next entry to replay
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        for kind in os.listdir(path):
+            if not os.path.isdir(os.path.join(path, kind)):
+                continue
+            for name in os.listdir(os.path.join(path, kind)):
+                if not name.endswith(".json.gz"):
+                    continue
+                key, n = name.split(".")[:2]
+                self._counts[(kind, key)] = max(self._counts.get((kind, key), 0), int(n) + 1)
+        if mode == REPLAY and not self._counts:
+            print(f"[cassette] {path} is empty, every request will miss")
+
+    @staticmethod
+    def key_for(kind: str, request: dict) -> str:
+        payload = json.dumps({"kind": kind, "request": request}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, kind: str, key: str, n: int) -> str:
+        return os.path.join(self.path, kind, f"{key}.{n}.json.gz")
+
+    def _write(self, kind: str, request: dict, response: Any, error: Optional[str], seconds: float):
+        key = self.key_for(kind, request)
+        with self._lock:
+            n = self._counts.get((kind, key), 0)
+            self._counts[(kind, key)] = n + 1
+            self.recorded[kind] = self.recorded.get(kind, 0) + 1
+        os.makedirs(os.path.join(self.path, kind), exist_ok=True)
+        entry = {"kind": kind, "request": request, "response": response, "error": error, "seconds": seconds}
+        temporary_path = self._entry_path(kind, key, n) + ".tmp"
+        with gzip.open(temporary_path, "wt", encoding="utf-8") as file:
+            json.dump(entry, file, ensure_ascii=False)
+        os.replace(temporary_path, self._entry_path(kind, key, n))
+
+    def _read(self, kind: str, request: dict) -> Optional[dict]:
+        key = self.key_for(kind, request)
+        with self._lock:
+            count = self._counts.get((kind, key), 0)
+            if count == 0:
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                return None
+            # a request repeated more often than it was recorded gets the last recorded answer
+            n = min(self._replay_positions.get((kind, key), 0), count - 1)
+            self._replay_positions[(kind, key)] = n + 1
+            self.replayed[kind] = self.replayed.get(kind, 0) + 1
+        with gzip.open(self._entry_path(kind, key, n), "rt", encoding="utf-8") as file:
+            return json.load(file)
+
+    def _replay(self, kind: str, request: dict, decode: Callable, errors: Tuple[type, ...], default: Any) -> Tuple[Any, float]:
+        entry = self._read(kind, request)
+        if entry is None:
+            print(f"[cassette] no {kind} recorded for {json.dumps(request, ensure_ascii=False)[:200]}")
+            if default is _missing:
+                raise CassetteMiss(f"no {kind} recorded for this request in {self.path}")
+            return default, 0.0
+        if entry["error"] is not None:
+            error_type = errors[0] if errors else CassetteMiss
+            raise error_type(entry["error"])
+        return decode(entry["response"]), entry["seconds"]
+
+    def call(
+        self,
+        kind: str,
+        request: dict,
+        func: Callable[[], Any],
+        encode: Callable[[Any], Any] = _identity,
+        decode: Callable[[Any], Any] = _identity,
+        errors: Tuple[type, ...] = (),
+        default: Any = _missing
+    ) -> Any:
+        if self.mode == REPLAY:
+            response, seconds = self._replay(kind, request, decode, errors, default)
+            if self.replay_latency:
+                time.sleep(seconds)
+            return response
+
+        start = time.perf_counter()
+        try:
+            response = func()
+        except errors as e:
+            self._write(kind, request, None, str(e), time.perf_counter() - start)
+            raise
+        self._write(kind, request, encode(response), None, time.perf_counter() - start)
+        return response
+
+    async def acall(
+        self,
+        kind: str,
+        request: dict,
+        func: Callable[[], Awaitable[Any]],
+        encode: Callable[[Any], Any] = _identity,
+        decode: Callable[[Any], Any] = _identity,
+        errors: Tuple[type, ...] = (),
+        default: Any = _missing
+    ) -> Any:
+        if self.mode == REPLAY:
+            response, seconds = self._replay(kind, request, decode, errors, default)
+            if self.replay_latency:
+                await asyncio.sleep(seconds)
+            return response
+
+        start = time.perf_counter()
+        try:
+            response = await func()
+        except errors as e:
+            self._write(kind, request, None, str(e), time.perf_counter() - start)
+            raise
+        self._write(kind, request, encode(response), None, time.perf_counter() - start)
+        return response
+
+    def entries(self, kind: str) -> Iterator[dict]:
+        directory = os.path.join(self.path, kind)
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(".json.gz"):
+                with gzip.open(os.path.join(directory, name), "rt", encoding="utf-8") as file:
+                    yield json.load(file)
+
+    def write_metadata(self, metadata: dict):
+        # parameters and outcome of the recorded run, so a replay can repeat and check it
+        with open(os.path.join(self.path, "cassette.json"), "w", encoding="utf-8") as file:
+            json.dump(metadata, file, ensure_ascii=False, indent=2)
+
+    def read_metadata(self) -> Optional[dict]:
+        path = os.path.join(self.path, "cassette.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as file:
+            return json.load(file)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "recorded": dict(self.recorded),
+                "replayed": dict(self.replayed),
+                "misses": dict(self.misses),
+            }
+
+cassette: Optional[Cassette] = None
+
+def record_cassette(path: str) -> Cassette:
+    # new entries are added next to any already in the directory
+    global cassette
+    cassette = Cassette(path, RECORD)
+    return cassette
+
+def replay_cassette(path: str, replay_latency: bool = False) -> Cassette:
+    # replay_latency sleeps for the recorded duration of each entry, otherwise answers are immediate
+    global cassette
+    cassette = Cassette(path, REPLAY, replay_latency=replay_latency)
+    return cassette
+
+def eject_cassette() -> Optional[Cassette]:
+    global cassette
+    ejected, cassette = cassette, None
+    return ejected
+
+def call(kind: str, request: dict, func: Callable[[], Any], **options) -> Any:
+    active = cassette
+    if active is None:
+        return func()
+    return active.call(kind, request, func, **options)
+
+async def acall(kind: str, request: dict, func: Callable[[], Awaitable[Any]], **options) -> Any:
+    active = cassette
+    if active is None:
+        return await func()
+    return await active.acall(kind, request, func, **options)
@@ -0,0 +1,108 @@
+import io
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+import image_store
+
+def decode_grayscale(data: bytes, width: int, height: int) -> np.ndarray:
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("L").resize((width, height), Image.LANCZOS)
+        return np.asarray(image, dtype=np.float64)
+
+def dct_matrix(size: int) -> np.ndarray:
+    # orthonormal dct-ii basis, so the 2d transform of x is m @ x @ m.T
+    n = np.arange(size)
+    m = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2 / size)
+    m[0] /= np.sqrt(2)
+    return m
+
+_dct32 = dct_matrix(32)
+
+def bits_to_int(bits: np.ndarray) -> int:
+    return int("".join("1" if bit else "0" for bit in bits.flatten()), 2)
+
+def phash(data: bytes) -> int:
+    # 64 bit hash of the lowest frequencies of a 32x32 dct, compared to their median
+    pixels = decode_grayscale(data, 32, 32)
+    low = (_dct32 @ pixels @ _dct32.T)[:8, :8].flatten()
+    return bits_to_int(low > np.median(low[1:]))
+
+def dhash(data: bytes) -> int:
+    # 64 bit hash of whether each pixel of a 9x8 thumbnail is brighter than its right neighbour
+    pixels = decode_grayscale(data, 9, 8)
+    return bits_to_int(pixels[:, 1:] > pixels[:, :-1])
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+class PerceptualPrefilter:
+    # settles candidate images that are near duplicates of (accept) or far from (reject) the listing
+    # image without the llm; both hashes have to agree, anything in between is left to the model
+    def __init__(self, accept_distance: Optional[int] = 6, reject_distance: Optional[int] = 30):
+        self.accept_distance = accept_distance
+        self.reject_distance = reject_distance
+        self.accepted, self.rejected, self.ambiguous, self.undecodable = 0, 0, 0, 0
+        self._hashes = {} # content sha256 -> (phash, dhash), or None if it does not decode
+        self._lock = threading.Lock()
+
+    def hashes(self, url: str) -> Optional[Tuple[int, int]]:
+        image = image_store.get_image(url)
+        if image is None:
+            return None
+        with self._lock:
+            if image.sha256 in self._hashes:
+                return self._hashes[image.sha256]
+        try:
+            hashes = (phash(image.data), dhash(image.data))
+        except Exception as e:
+            print(f"[image_hash] could not decode image {url}: {e}")
+            hashes = None # remembered too, so an undecodable image is only attempted once
+        with self._lock:
+            self._hashes[image.sha256] = hashes
+        return hashes
+
+    def distances(self, url: str, other_url: str) -> Optional[Tuple[int, int]]:
+        hashes, other_hashes = self.hashes(url), self.hashes(other_url)
+        if hashes is None or other_hashes is None:
+            return None
+        return hamming(hashes[0], other_hashes[0]), hamming(hashes[1], other_hashes[1])
+
+    def judge(self, url: str, candidate_url: str) -> Tuple[Optional[bool], Optional[Tuple[int, int]]]:
+        # returns True for near duplicates, False for clearly different images and None when the
+        # model has to decide, along with the (phash, dhash) distances
+        distances = self.distances(url, candidate_url)
+        with self._lock:
+            if distances is None:
+                self.undecodable += 1
+                return None, None
+            if self.accept_distance is not None and max(distances) <= self.accept_distance:
+                self.accepted += 1
+                return True, distances
+            if self.reject_distance is not None and min(distances) >= self.reject_distance:
+                self.rejected += 1
+                return False, distances
+            self.ambiguous += 1
+            return None, distances
+
+    def stats(self) -> dict:
+        with self._lock:
+            judged = self.accepted + self.rejected + self.ambiguous + self.undecodable
+            return {
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "ambiguous": self.ambiguous,
+                "undecodable": self.undecodable,
+                "llm_image_slots_saved": self.accepted + self.rejected,
+                "saved_rate": (self.accepted + self.rejected) / judged if judged else 0.0,
+            }
+
+prefilter = PerceptualPrefilter()
+
+def configure_prefilter(accept_distance: Optional[int] = 6, reject_distance: Optional[int] = 30) -> PerceptualPrefilter:
+    # None disables that side of the filter
+    global prefilter
+    prefilter = PerceptualPrefilter(accept_distance=accept_distance, reject_distance=reject_distance)
+    return prefilter
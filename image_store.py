@@ -0,0 +1,230 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from functools import cached_property
+from typing import Optional, Tuple
+
+import httpx
+
+import cassette
+from scraper.scheduler import SUCCESS, THROTTLED, ERROR, fetch_scheduler
+from single_flight import SingleFlight
+
+class StoredImage:
+    def __init__(self, url: str, data: bytes, content_type: str, sha256: Optional[str] = None):
+        self.url = url
+        self.data = data
+        self.content_type = content_type
+        self.sha256 = sha256 or hashlib.sha256(data).hexdigest()
+
+    @cached_property
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode("utf-8")
+
+class ImageStore:
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024, disk_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+        self.hits, self.disk_hits, self.misses, self.failures, self.evictions = 0, 0, 0, 0, 0
+        self._images = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def get_image(self, url: str) -> Optional[StoredImage]:
+        image = self._lookup(url)
+        if image is not None:
+            return image
+        return image_fetches.do((id(self), url), lambda: self._fetch(url))
+
+    async def aget_image(self, url: str) -> Optional[StoredImage]:
+        image = self._lookup(url)
+        if image is not None:
+            return image
+        return await image_fetches.ado((id(self), url), lambda: self._afetch(url))
+
+    def _fetch(self, url: str) -> Optional[StoredImage]:
+        image = self._recent(url)
+        if image is not None:
+            return image
+        try:
+            fetched = cassette.call("image", {"url": url}, lambda: self._download(url), encode=encode_download, decode=decode_download, errors=(httpx.HTTPError,), default=None)
+        except httpx.HTTPError as e:
+            print(f"[image_store] HTTP error occurred while fetching image {url}: {e}")
+            self._failed()
+            return None
+        if fetched is None:
+            self._failed()
+            return None
+        return self._store(url, *fetched)
+
+    def _download(self, url: str) -> Tuple[bytes, str]:
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(follow_redirects=True, timeout=30)
+            client = self._client
+        response = fetch_scheduler.call(url, lambda: client.get(url), classify_image_response)
+        response.raise_for_status()
+        return response.content, response.headers.get("Content-Type", "")
+
+    async def _afetch(self, url: str) -> Optional[StoredImage]:
+        image = self._recent(url)
+        if image is not None:
+            return image
+        try:
+            fetched = await cassette.acall("image", {"url": url}, lambda: self._adownload(url), encode=encode_download, decode=decode_download, errors=(httpx.HTTPError,), default=None)
+        except httpx.HTTPError as e:
+            print(f"[image_store] HTTP error occurred while fetching image {url}: {e}")
+            self._failed()
+            return None
+        if fetched is None:
+            self._failed()
+            return None
+        return self._store(url, *fetched)
+
+    async def _adownload(self, url: str) -> Tuple[bytes, str]:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._async_clients:
+                self._async_clients[loop] = httpx.AsyncClient(
+                    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                    follow_redirects=True,
+                    timeout=30
+                )
+            client = self._async_clients[loop]
+        response = await fetch_scheduler.acall(url, lambda: client.get(url), classify_image_response)
+        response.raise_for_status()
+        return response.content, response.headers.get("Content-Type", "")
+
+    def _failed(self):
+        # counters are updated under the lock, get runs on many listing and term threads at once
+        with self._lock:
+            self.failures += 1
+
+    def _lookup(self, url: str) -> Optional[StoredImage]:
+        with self._lock:
+            image = self._images.get(url)
+            if image is not None:
+                self._images.move_to_end(url)
+                self.hits += 1
+                return image
+        image = self._read_disk(url)
+        if image is not None:
+            self._remember(image, disk_hit=True)
+            return image
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _recent(self, url: str) -> Optional[StoredImage]:
+        # a fetch for the same url may have finished between our lookup and joining the flight
+        with self._lock:
+            return self._images.get(url)
+
+    def _store(self, url: str, data: bytes, content_type: str) -> StoredImage:
+        image = StoredImage(url, data, content_type)
+        self._remember(image)
+        self._write_disk(image)
+        return image
+
+    def _remember(self, image: StoredImage, disk_hit: bool = False):
+        with self._lock:
+            if disk_hit:
+                self.disk_hits += 1
+            previous = self._images.pop(image.url, None)
+            if previous is not None:
+                self._size -= len(previous.data)
+            self._images[image.url] = image
+            self._size += len(image.data)
+            while self._size > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._size -= len(evicted.data)
+                self.evictions += 1
+
+    # on disk, urls map to a small json index entry and image bytes are stored once per content hash
+    def _index_path(self, url: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.disk_dir, sha256 + ".bin")
+
+    def _read_disk(self, url: str) -> Optional[StoredImage]:
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._index_path(url), "r", encoding="utf-8") as file:
+                index = json.load(file)
+            with open(self._blob_path(index["sha256"]), "rb") as file:
+                data = file.read()
+        except (OSError, ValueError, KeyError):
+            return None
+        return StoredImage(url, data, index["content_type"], index["sha256"])
+
+    def _write_disk(self, image: StoredImage):
+        if not self.disk_dir:
+            return
+        try:
+            blob_path = self._blob_path(image.sha256)
+            if not os.path.exists(blob_path):
+                write_atomic(blob_path, image.data)
+            index = {"url": image.url, "sha256": image.sha256, "content_type": image.content_type}
+            write_atomic(self._index_path(image.url), json.dumps(index).encode("utf-8"))
+        except OSError as e:
+            print(f"[image_store] failed to write image {image.url} to disk: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = len(self._images), self._size
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": size,
+        }
+
+def write_atomic(path: str, data: bytes):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+def classify_image_response(response: httpx.Response) -> str:
+    # a missing image is an answer rather than a reason to retry or slow the cdn down
+    if response.status_code in [429, 503]:
+        return THROTTLED
+    return ERROR if response.status_code >= 500 else SUCCESS
+
+# cassette entries for downloads, bytes are kept as base64 in json
+def encode_download(download: Tuple[bytes, str]) -> dict:
+    return {"content": base64.b64encode(download[0]).decode("utf-8"), "content_type": download[1]}
+
+def decode_download(entry: dict) -> Tuple[bytes, str]:
+    return base64.b64decode(entry["content"]), entry["content_type"]
+
+# concurrent misses for the same url share one download
+image_fetches = SingleFlight("image_fetch")
+
+# process-wide store used by both the scraper and the llm layer
+store = ImageStore()
+
+def configure_image_store(max_bytes: int = 128 * 1024 * 1024, disk_dir: Optional[str] = None) -> ImageStore:
+    global store
+    store = ImageStore(max_bytes=max_bytes, disk_dir=disk_dir)
+    return store
+
+def get_image(url: str) -> Optional[StoredImage]:
+    return store.get_image(url)
+
+async def aget_image(url: str) -> Optional[StoredImage]:
+    return await store.aget_image(url)
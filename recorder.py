@@ -1,11 +1,130 @@
+import json
+import os
+import threading
+from typing import Iterator, List, Optional
+
 import yaml
 
+# libyaml bindings are an order of magnitude faster, fall back to the pure python ones when missing
+YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+YamlSafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 def writeRuntimeState(state: list, output_path: str):
     with open(output_path, "a", encoding="utf-8") as file:
-        yaml.dump(state, file, allow_unicode=True)
-        
-        
+        yaml.dump(state, file, allow_unicode=True, Dumper=YamlDumper)
+
+class RunLog:
+    # append-only jsonl log of analyses; a sidecar index maps each key (the term) to the byte offset
+    # and length of its record so single records can be read back without parsing the whole log
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.offsets = {}
+        self._lock = threading.Lock()
+        # a crash mid-write can leave a torn final line, which the next append would be glued onto
+        size = truncateTornLine(path)
+        truncateTornLine(self.index_path)
+        self._load_index(size)
+
+    def _load_index(self, size: int):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry["offset"] + entry["length"] <= size:
+                    self.offsets[entry["key"]] = (entry["offset"], entry["length"])
+
+    def append(self, record: dict, key: Optional[str] = None) -> int:
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            with open(self.path, "ab") as file:
+                offset = file.tell()
+                file.write(line)
+            if key is not None:
+                self.offsets[key] = (offset, len(line))
+                with open(self.index_path, "a", encoding="utf-8") as file:
+                    file.write(json.dumps({"key": key, "offset": offset, "length": len(line)}, ensure_ascii=False) + "\n")
+        return offset
+
+    def read(self, key: str) -> Optional[dict]:
+        if key not in self.offsets:
+            return None
+        offset, length = self.offsets[key]
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            return json.loads(file.read(length))
+
+    def keys(self) -> List[str]:
+        return list(self.offsets)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.offsets
+
+    def __iter__(self) -> Iterator[dict]:
+        return iterRunLog(self.path)
+
+def iterRunLog(source_path: str) -> Iterator[dict]:
+    # streams records from a jsonl run log, or from a legacy yaml term_search.yml
+    if source_path.endswith((".yml", ".yaml")):
+        with open(source_path, "r", encoding="utf-8") as file:
+            yield from yaml.load(file, Loader=YamlSafeLoader) or []
+        return
+    with open(source_path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if line.endswith("\n"):
+                    raise
+                print(f"[recorder] skipping torn final line of {source_path}")
+                return
+            yield record
+
+def truncateTornLine(path: str) -> int:
+    # cuts a jsonl file back to its last complete line and returns its size
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as file:
+        size = file.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - 4096)
+            file.seek(start)
+            newline = file.read(end - start).rfind(b"\n")
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            print(f"[recorder] dropping a torn final line from {path}")
+            file.truncate(end)
+    return end
+
 def createVisualizationFrom(source_path: str, output_path: str):
-    data = yaml.safe_load(open(source_path, "r"))
+    # writes the list of analyses preview.html expects, as json (which js-yaml reads as yaml),
+    # one record at a time
     with open(output_path, "w", encoding="utf-8") as file:
-        file.write() 
\ No newline at end of file
+        file.write("[")
+        for i, record in enumerate(iterRunLog(source_path)):
+            file.write(",\n" if i else "\n")
+            file.write(json.dumps(record, ensure_ascii=False))
+        file.write("\n]\n")
+
+def writeCheckpoint(checkpoint: dict, output_path: str):
+    # written to a temporary file and swapped in, so a crash mid-write leaves the previous checkpoint
+    tmp_path = f"{output_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(checkpoint, file, ensure_ascii=False)
+    os.replace(tmp_path, output_path)
+
+def readCheckpoint(source_path: str) -> Optional[dict]:
+    if not os.path.exists(source_path):
+        return None
+    with open(source_path, "r", encoding="utf-8") as file:
+        return json.load(file)
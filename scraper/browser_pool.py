@@ -0,0 +1,168 @@
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+from playwright.async_api import async_playwright
+
+userAgentStrings = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.2227.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.3497.92 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36',
+]
+
+stealth_script = """
+    Object.defineProperty(navigator, 'webdriver', {get: () => undefined})
+    const get_param = (module, param) => {
+        return Object.values(module._nodeModulesPolyfillHeaders)[0][param];
+    }
+    Object.defineProperty(window, 'RTCPeerConnection', {
+        value: get_param(window.RTCPeerConnection, 'mozRTCPeerConnection')
+    });
+    Object.defineProperty(window, 'RTCSessionDescription', {
+        value: get_param(window.RTCSessionDescription, 'mozRTCSessionDescription')
+    });
+"""
+
+class BrowserSlot:
+    def __init__(self, context, page, proxy: Optional[str]):
+        self.context = context
+        self.page = page
+        self.proxy = proxy
+        self.failures = 0
+        self.uses = 0
+
+class BrowserPool:
+    # one chromium process shared by up to `size` contexts, each with its own page, cookies and proxy
+    def __init__(
+        self,
+        size: int = 3,
+        headless: bool = False,
+        max_failures: int = 2,
+        max_uses: int = 50,
+        default_timeout: float = 300000,
+        proxy_timeout: float = 60000,
+        proxy_provider: Optional[Callable[[], Optional[str]]] = None,
+        proxy_reporter: Optional[Callable[[str, bool], None]] = None
+    ):
+        self.size = size
+        self.headless = headless
+        self.max_failures = max_failures
+        self.max_uses = max_uses
+        self.default_timeout = default_timeout
+        self.proxy_timeout = proxy_timeout
+        self.proxy_provider = proxy_provider
+        self.proxy_reporter = proxy_reporter
+        self.created, self.recycled = 0, 0
+        self._playwright = None
+        self._browser = None
+        self._idle = []
+        self._open = 0
+        self._semaphore = None
+        self._start_lock = None
+
+    async def _ensure_started(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._browser is None or not self._browser.is_connected():
+                print("[browser_pool] launching browser")
+                if self._playwright is None:
+                    self._playwright = await async_playwright().start()
+                self._browser = await self._playwright.chromium.launch(headless=self.headless)
+                # idle contexts died with the old browser, checked out ones are recycled when released
+                self._open -= len(self._idle)
+                self._idle = []
+                if self._semaphore is None:
+                    self._semaphore = asyncio.Semaphore(self.size)
+
+    async def _new_slot(self, with_proxy: bool) -> BrowserSlot:
+        proxy = None
+        if with_proxy and self.proxy_provider is not None:
+            proxy = await asyncio.to_thread(self.proxy_provider)
+            if proxy is None:
+                print("[browser_pool] could not retrieve proxy, proceeding without proxy")
+
+        context = await self._browser.new_context(
+            user_agent=random.choice(userAgentStrings),
+            ignore_https_errors=True,
+            proxy={"server": proxy} if proxy else None
+        )
+        await context.add_init_script(stealth_script)
+        # a dead proxy should surface quickly instead of after the default five minutes
+        context.set_default_timeout(self.proxy_timeout if proxy else self.default_timeout)
+        page = await context.new_page()
+
+        self._open += 1
+        self.created += 1
+        print(f"[browser_pool] context and page initialized with proxy={proxy}")
+        return BrowserSlot(context, page, proxy)
+
+    async def _close_slot(self, slot: BrowserSlot):
+        self._open -= 1
+        try:
+            await slot.context.close()
+        except Exception as e:
+            print(f"[browser_pool] error while closing context: {e}")
+
+    async def acquire(self, with_proxy: bool = False) -> BrowserSlot:
+        await self._ensure_started()
+        await self._semaphore.acquire()
+        try:
+            for slot in self._idle:
+                if (slot.proxy is not None) == with_proxy:
+                    self._idle.remove(slot)
+                    return slot
+            # no idle context with the right proxy setting, make room by retiring the oldest idle one
+            if self._open >= self.size and self._idle:
+                await self._close_slot(self._idle.pop(0))
+            return await self._new_slot(with_proxy)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    async def release(self, slot: BrowserSlot, healthy: bool = True):
+        slot.uses += 1
+        slot.failures = 0 if healthy else slot.failures + 1
+        if slot.proxy is not None and self.proxy_reporter is not None:
+            self.proxy_reporter(slot.proxy, healthy)
+        try:
+            if slot.failures >= self.max_failures or slot.uses >= self.max_uses or slot.page.is_closed():
+                print(f"[browser_pool] recycling context after {slot.uses} uses and {slot.failures} consecutive failures")
+                self.recycled += 1
+                await self._close_slot(slot)
+            else:
+                self._idle.append(slot)
+        finally:
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self, with_proxy: bool = False):
+        slot = await self.acquire(with_proxy)
+        healthy = False
+        try:
+            yield slot
+            healthy = True
+        finally:
+            await self.release(slot, healthy)
+
+    async def close(self):
+        if self._browser is not None:
+            print("[browser_pool] closing browser")
+            try:
+                await self._browser.close()
+            except Exception as e:
+                print(f"[browser_pool] error while closing browser: {e}")
+        if self._playwright is not None:
+            await self._playwright.stop()
+        self._browser, self._playwright, self._idle, self._open = None, None, [], 0
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "open": self._open,
+            "idle": len(self._idle),
+            "created": self.created,
+            "recycled": self.recycled,
+        }
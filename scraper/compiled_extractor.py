@@ -0,0 +1,76 @@
+import yaml
+from typing import Any, Optional
+
+from lxml import etree, html
+from parsel.csstranslator import HTMLTranslator
+
+# a drop-in for selectorlib's Extractor: layouts are translated to xpath once with the same css
+# translator parsel uses, compiled with lxml, and evaluated on a single lxml parse of the page
+
+_translator = HTMLTranslator()
+_namespaces = {"re": "http://exslt.org/regular-expressions"}
+_text_xpath = etree.XPath(".//text()")
+_href_xpath = etree.XPath(".//@href")
+
+class CompiledField:
+    def __init__(self, name: str, config: dict):
+        self.name = name
+        if config.get("xpath") is not None:
+            query = config["xpath"]
+        elif config["css"] == "":
+            query = None
+        else:
+            query = _translator.css_to_xpath(config["css"])
+        self.xpath = etree.XPath(query, namespaces=_namespaces, smart_strings=False) if query else None
+        self.type = config.get("type", "Text")
+        self.attribute = config.get("attribute")
+        self.multiple = config.get("multiple") is True
+        self.children = [CompiledField(child, child_config) for child, child_config in config["children"].items()] if "children" in config else None
+        assert "format" not in config, "formatters are not supported by the compiled extractor"
+        assert self.type in ["Text", "Link", "Image", "Attribute", "HTML"], f"unsupported field type {self.type}"
+
+    def extract(self, node) -> Any:
+        elements = self.xpath(node) if self.xpath is not None else [node]
+        if not elements:
+            return None
+
+        if not self.multiple:
+            return self._value(elements[0])
+        return [self._value(element) for element in elements]
+
+    def _value(self, element) -> Any:
+        if self.children is not None:
+            return {child.name: child.extract(element) for child in self.children}
+        if self.type == "Text":
+            return " ".join(text.strip() for text in _text_xpath(element) if text.strip())
+        if self.type == "Link":
+            hrefs = _href_xpath(element)
+            return str(hrefs[0]) if hrefs else None
+        if self.type == "Image":
+            return element.get("src")
+        if self.type == "Attribute":
+            return element.get(self.attribute)
+        return etree.tostring(element, method="html", encoding="unicode", with_tail=False)
+
+class CompiledExtractor:
+    def __init__(self, config: dict):
+        self.config = config
+        self.fields = [CompiledField(name, field_config) for name, field_config in config.items()]
+
+    @classmethod
+    def from_yaml_file(cls, yaml_filename: str) -> "CompiledExtractor":
+        with open(yaml_filename) as file:
+            return cls(yaml.safe_load(file))
+
+    def extract(self, html_text: str) -> dict:
+        root = parse_html(html_text)
+        return {field.name: field.extract(root) for field in self.fields}
+
+def parse_html(html_text: str):
+    # mirrors parsel's root node creation so both engines see the same tree
+    body = html_text.strip().replace("\x00", "").encode("utf-8") or b"<html/>"
+    parser = html.HTMLParser(recover=True, encoding="utf-8", huge_tree=True)
+    root: Optional[etree._Element] = etree.fromstring(body, parser=parser)
+    if root is None:
+        root = etree.fromstring(b"<html/>", parser=parser)
+    return root
@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional, Tuple
+
+class CorpusCache:
+    # zlib compressed result pages keyed by (source, key), where key is the search keyword or, for
+    # image searches, the content hashes of the uploaded images
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024, ttl: Optional[float] = 24 * 3600):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits, self.misses, self.expired, self.evictions = 0, 0, 0, 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS corpora ("
+            "source TEXT NOT NULL, key TEXT NOT NULL, corpus BLOB NOT NULL, size INTEGER NOT NULL, "
+            "fetched REAL NOT NULL, last_access REAL NOT NULL, PRIMARY KEY (source, key))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS corpora_last_access ON corpora(last_access)")
+
+    def get(self, source: str, key: str) -> Optional[Tuple[str, float]]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT corpus, fetched FROM corpora WHERE source = ? AND key = ?", (source, key)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            corpus, fetched = row
+            if self.ttl is not None and now - fetched > self.ttl:
+                self._db.execute("DELETE FROM corpora WHERE source = ? AND key = ?", (source, key))
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE corpora SET last_access = ? WHERE source = ? AND key = ?", (now, source, key))
+            self.hits += 1
+        return zlib.decompress(corpus).decode("utf-8"), fetched
+
+    def put(self, source: str, key: str, corpus: str):
+        compressed = zlib.compress(corpus.encode("utf-8"), 6)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO corpora (source, key, corpus, size, fetched, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (source, key, compressed, len(compressed), now, now)
+            )
+            self._evict()
+
+    def invalidate(self, source: str, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM corpora WHERE source = ? AND key = ?", (source, key))
+
+    def _evict(self):
+        if self.ttl is not None:
+            self.evictions += self._db.execute("DELETE FROM corpora WHERE fetched < ?", (time.time() - self.ttl,)).rowcount
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM corpora").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for source, key, size in self._db.execute("SELECT source, key, size FROM corpora ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM corpora WHERE source = ? AND key = ?", (source, key))
+            total -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM corpora").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "compressed_bytes": size,
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,83 @@
+import asyncio
+import threading
+import time
+import yaml
+from typing import Optional
+
+# time actually spent waiting for pages, keyed by the wait label
+wait_stats = {}
+_stats_lock = threading.Lock()
+
+def load_products_selector(layout_path: str) -> Optional[str]:
+    with open(layout_path, "r") as file:
+        layout = yaml.safe_load(file)
+    return layout.get("products", {}).get("css")
+
+def record_wait(label: str, seconds: float, timed_out: bool):
+    with _stats_lock:
+        stats = wait_stats.setdefault(label, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "timeouts": 0})
+        stats["count"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["timeouts"] += int(timed_out)
+
+def readiness_stats() -> dict:
+    with _stats_lock:
+        return {
+            label: dict(stats, mean_seconds=stats["total_seconds"] / stats["count"])
+            for label, stats in wait_stats.items()
+        }
+
+async def mark_stale(page, selector: str):
+    # tags the cards currently on the page so a following wait only counts freshly rendered ones
+    await page.evaluate(
+        "(selector) => document.querySelectorAll(selector).forEach(e => e.setAttribute('data-stale', ''))",
+        selector
+    )
+
+async def wait_until_ready(
+    page,
+    label: str,
+    selector: Optional[str] = None,
+    expected: int = 1,
+    timeout: float = 15000,
+    network_idle: bool = True
+) -> bool:
+    # ready as soon as the layout's products container holds the expected number of cards, or the
+    # network goes idle, whichever happens first; gives up after timeout milliseconds
+    start = time.perf_counter()
+    waits = []
+    if network_idle:
+        waits.append(asyncio.ensure_future(page.wait_for_load_state("networkidle", timeout=timeout)))
+    if selector:
+        waits.append(asyncio.ensure_future(page.wait_for_function(
+            "([selector, expected]) => document.querySelectorAll(selector).length >= expected",
+            arg=[selector, expected],
+            timeout=timeout
+        )))
+
+    ready = False
+    pending = set(waits)
+    while pending and not ready:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        ready = any(task.exception() is None for task in done)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    seconds = time.perf_counter() - start
+    record_wait(label, seconds, not ready)
+    if not ready:
+        print(f"[wait_until_ready] {label} not ready after {seconds:.1f}s, continuing with current page")
+    return ready
+
+async def wait_for_element(page, label: str, selector: str, timeout: float = 15000) -> bool:
+    start = time.perf_counter()
+    try:
+        await page.wait_for_selector(selector, timeout=timeout)
+        ready = True
+    except Exception as e:
+        print(f"[wait_for_element] {label} - {selector} did not appear: {e}")
+        ready = False
+    record_wait(label, time.perf_counter() - start, not ready)
+    return ready
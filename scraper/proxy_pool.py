@@ -0,0 +1,189 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+class ProxyStats:
+    def __init__(self, proxy: str):
+        self.proxy = proxy
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None # exponentially weighted moving average in seconds
+        self.last_checked = 0.0
+        self.ejected_at = None
+
+    def record(self, success: bool, latency: Optional[float] = None):
+        self.last_checked = time.time()
+        if success:
+            self.successes += 1
+            self.consecutive_failures = 0
+            if latency is not None:
+                self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+
+    @property
+    def success_rate(self) -> float:
+        # laplace smoothed so a single lucky check does not outrank a proven proxy
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def score(self) -> float:
+        return self.success_rate / (1 + (self.latency if self.latency is not None else 5.0))
+
+    def as_dict(self) -> dict:
+        return {
+            "successes": self.successes,
+            "failures": self.failures,
+            "success_rate": round(self.success_rate, 3),
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "score": round(self.score, 4),
+            "ejected": self.ejected_at is not None,
+        }
+
+class ProxyPool:
+    def __init__(
+        self,
+        sources: List[Callable[[], List[str]]],
+        validate_url: str = "https://www.amazon.com/robots.txt",
+        validate_timeout: float = 5,
+        validate_workers: int = 32,
+        refresh_interval: float = 600,
+        max_consecutive_failures: int = 3,
+        min_success_rate: float = 0.3,
+        eject_cooldown: float = 1800,
+        min_ready: int = 3
+    ):
+        self.sources = sources
+        self.validate_url = validate_url
+        self.validate_timeout = validate_timeout
+        self.validate_workers = validate_workers
+        self.refresh_interval = refresh_interval
+        self.max_consecutive_failures = max_consecutive_failures
+        self.min_success_rate = min_success_rate
+        self.eject_cooldown = eject_cooldown
+        self.min_ready = min_ready
+        self.proxies: Dict[str, ProxyStats] = {}
+        self.refreshes = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        with self._refresh_lock:
+            candidates = []
+            for source in self.sources:
+                try:
+                    candidates += [normalize_proxy(proxy) for proxy in source()]
+                except Exception as e:
+                    print(f"[proxy_pool] proxy source {getattr(source, '__name__', source)} failed: {e}")
+
+            now = time.time()
+            with self._lock:
+                to_check = [
+                    proxy for proxy in dict.fromkeys(candidates)
+                    if proxy not in self.proxies
+                    or self.proxies[proxy].ejected_at is None
+                    or now - self.proxies[proxy].ejected_at > self.eject_cooldown
+                ]
+
+            with ThreadPoolExecutor(max_workers=self.validate_workers) as executor:
+                results = list(executor.map(self._validate_candidate, to_check))
+            self.refreshes += 1
+            print(f"[proxy_pool] validated {len(to_check)} proxies, {sum(results)} usable")
+
+    def _validate_candidate(self, proxy: str) -> bool:
+        # waiting callers are let go as soon as min_ready proxies are healthy, the refresh validates
+        # the rest in the background
+        success = self.validate(proxy)
+        if success:
+            with self._lock:
+                ready = len(self._healthy()) >= self.min_ready
+            if ready:
+                self._ready.set()
+        return success
+
+    def validate(self, proxy: str) -> bool:
+        start = time.perf_counter()
+        try:
+            with httpx.Client(proxy=proxy, timeout=self.validate_timeout, verify=False) as client:
+                response = client.get(self.validate_url)
+            success = response.status_code < 500
+        except Exception:
+            success = False
+        with self._lock:
+            stats = self.proxies.setdefault(proxy, ProxyStats(proxy))
+            if success:
+                stats.ejected_at = None
+            elif stats.ejected_at is not None:
+                stats.ejected_at = time.time()
+        self.report(proxy, success, time.perf_counter() - start)
+        return success
+
+    def report(self, proxy: str, success: bool, latency: Optional[float] = None):
+        with self._lock:
+            stats = self.proxies.setdefault(proxy, ProxyStats(proxy))
+            stats.record(success, latency)
+            never_worked = not success and stats.successes == 0
+            failing = stats.consecutive_failures >= self.max_consecutive_failures
+            unreliable = stats.successes + stats.failures >= 5 and stats.success_rate < self.min_success_rate
+            if stats.ejected_at is None and (never_worked or failing or unreliable):
+                stats.ejected_at = time.time()
+
+    def best(self) -> Optional[str]:
+        self.start()
+        with self._lock:
+            healthy = self._healthy()
+            if not healthy:
+                return None
+            # pick among the top scorers so concurrent contexts do not all pile onto one proxy
+            healthy.sort(key=lambda stats: stats.score, reverse=True)
+            return random.choice(healthy[:3]).proxy
+
+    def _healthy(self) -> List[ProxyStats]:
+        return [stats for stats in self.proxies.values() if stats.ejected_at is None and stats.successes > 0]
+
+    def start(self):
+        # the first refresh runs on the background thread, callers wait until min_ready proxies are
+        # validated (or the whole first refresh is done) rather than for every candidate
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refresh_loop, name="proxy-refresh", daemon=True)
+                self._thread.start()
+        self._ready.wait()
+
+    def stop(self):
+        self._stop.set()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"[proxy_pool] background refresh failed: {e}")
+            finally:
+                self._ready.set()
+            if self._stop.wait(self.refresh_interval):
+                return
+
+    def stats(self) -> dict:
+        with self._lock:
+            proxies = {proxy: stats.as_dict() for proxy, stats in self.proxies.items()}
+        return {
+            "refreshes": self.refreshes,
+            "known": len(proxies),
+            "healthy": sum(1 for stats in proxies.values() if not stats["ejected"] and stats["successes"] > 0),
+            "ejected": sum(1 for stats in proxies.values() if stats["ejected"]),
+            "proxies": proxies,
+        }
+
+def normalize_proxy(proxy: str) -> str:
+    proxy = proxy.strip()
+    return proxy if "://" in proxy else f"http://{proxy}"
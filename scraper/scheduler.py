@@ -0,0 +1,179 @@
+import asyncio
+import random
+import threading
+import time
+import urllib.parse
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from tracing import span
+
+# outcomes a fetch is classified into after it completes
+SUCCESS, THROTTLED, ERROR = "success", "throttled", "error"
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def domain_of(url: str) -> str:
+    return urllib.parse.urlsplit(url).hostname or url
+
+class DomainLimits:
+    def __init__(self, rate: float = 2.0, burst: int = 2, initial_concurrency: float = 2, max_concurrency: int = 6, min_concurrency: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+
+class DomainState:
+    def __init__(self, limits: DomainLimits):
+        self.limits = limits
+        self.tokens = float(limits.burst)
+        self.refilled_at = time.monotonic()
+        self.concurrency = float(limits.initial_concurrency)
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.consecutive_throttles = 0
+        self.stats = {"requests": 0, "successes": 0, "throttled": 0, "errors": 0, "retries": 0, "wait_seconds": 0.0}
+
+class FetchScheduler:
+    # token bucket rate limit per domain, plus an aimd concurrency limit that grows additively on
+    # success and halves on throttling (503, 429, captcha pages) while the domain cools down
+    def __init__(self, limits: Optional[Dict[str, DomainLimits]] = None, default_limits: Optional[DomainLimits] = None, poll_interval: float = 0.05):
+        self.limits = limits or {}
+        self.default_limits = default_limits or DomainLimits()
+        self.poll_interval = poll_interval
+        self._domains: Dict[str, DomainState] = {}
+        self._lock = threading.Lock()
+
+    def _state(self, domain: str) -> DomainState:
+        if domain not in self._domains:
+            self._domains[domain] = DomainState(self._limits_for(domain))
+        return self._domains[domain]
+
+    def _limits_for(self, domain: str) -> DomainLimits:
+        # limits set for a domain also cover its subdomains (cdn shards), each host keeps its own state
+        parts = domain.split(".")
+        for i in range(len(parts)):
+            suffix = ".".join(parts[i:])
+            if suffix in self.limits:
+                return self.limits[suffix]
+        return self.default_limits
+
+    def _try_acquire(self, domain: str) -> float:
+        # takes a slot and a token and returns 0, or returns how long to wait before trying again
+        now = time.monotonic()
+        with self._lock:
+            state = self._state(domain)
+            state.tokens = min(state.limits.burst, state.tokens + (now - state.refilled_at) * state.limits.rate)
+            state.refilled_at = now
+            if now < state.cooldown_until:
+                return state.cooldown_until - now
+            if state.in_flight >= int(state.concurrency):
+                return self.poll_interval
+            if state.tokens < 1:
+                return (1 - state.tokens) / state.limits.rate
+            state.tokens -= 1
+            state.in_flight += 1
+            state.stats["requests"] += 1
+            return 0
+
+    def acquire(self, domain: str):
+        start = time.perf_counter()
+        with span("scheduler_wait", "scraper", domain=domain):
+            while (wait := self._try_acquire(domain)) > 0:
+                time.sleep(wait)
+        self._record_wait(domain, time.perf_counter() - start)
+
+    async def aacquire(self, domain: str):
+        start = time.perf_counter()
+        with span("scheduler_wait", "scraper", domain=domain):
+            while (wait := self._try_acquire(domain)) > 0:
+                await asyncio.sleep(wait)
+        self._record_wait(domain, time.perf_counter() - start)
+
+    def _record_wait(self, domain: str, seconds: float):
+        with self._lock:
+            self._state(domain).stats["wait_seconds"] += seconds
+
+    def release(self, domain: str, outcome: str):
+        with self._lock:
+            state = self._state(domain)
+            state.in_flight -= 1
+            limits = state.limits
+            if outcome == SUCCESS:
+                state.stats["successes"] += 1
+                state.consecutive_throttles = 0
+                state.concurrency = min(limits.max_concurrency, state.concurrency + 1 / state.concurrency)
+            elif outcome == THROTTLED:
+                state.stats["throttled"] += 1
+                state.consecutive_throttles += 1
+                state.concurrency = max(limits.min_concurrency, state.concurrency / 2)
+                state.cooldown_until = max(state.cooldown_until, time.monotonic() + backoff_delay(state.consecutive_throttles))
+            else:
+                state.stats["errors"] += 1
+
+    def call(self, url: str, func: Callable[[], Any], classify: Callable[[Any], str], retries: int = 2) -> Any:
+        domain = domain_of(url)
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self._count_retry(domain)
+            self.acquire(domain)
+            outcome = ERROR
+            try:
+                result = func()
+                outcome = classify(result)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"[scheduler] {domain} attempt {attempt + 1} failed: {e}")
+                result = None
+            finally:
+                self.release(domain, outcome)
+            if outcome == SUCCESS or attempt == retries:
+                return result
+            time.sleep(backoff_delay(attempt))
+        return result
+
+    async def acall(self, url: str, func: Callable[[], Awaitable[Any]], classify: Callable[[Any], str], retries: int = 1) -> Any:
+        domain = domain_of(url)
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                self._count_retry(domain)
+            await self.aacquire(domain)
+            outcome = ERROR
+            try:
+                result = await func()
+                outcome = classify(result)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"[scheduler] {domain} attempt {attempt + 1} failed: {e}")
+                result = None
+            finally:
+                self.release(domain, outcome)
+            if outcome == SUCCESS or attempt == retries:
+                return result
+            await asyncio.sleep(backoff_delay(attempt))
+        return result
+
+    def _count_retry(self, domain: str):
+        with self._lock:
+            self._state(domain).stats["retries"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                domain: dict(state.stats, concurrency=round(state.concurrency, 2), in_flight=state.in_flight)
+                for domain, state in self._domains.items()
+            }
+
+# every request and page load goes through the scheduler, which rate limits per domain, backs off with
+# jitter and adapts concurrency to how often the site throttles us; image cdns take far more traffic
+fetch_scheduler = FetchScheduler(limits={
+    "www.amazon.com": DomainLimits(rate=1.0, burst=2, initial_concurrency=2, max_concurrency=6),
+    "s.1688.com": DomainLimits(rate=0.5, burst=2, initial_concurrency=2, max_concurrency=4),
+    "api.scraperapi.com": DomainLimits(rate=2.0, burst=4, initial_concurrency=4, max_concurrency=10),
+    "media-amazon.com": DomainLimits(rate=20.0, burst=20, initial_concurrency=8, max_concurrency=32),
+    "alicdn.com": DomainLimits(rate=20.0, burst=20, initial_concurrency=8, max_concurrency=32),
+})
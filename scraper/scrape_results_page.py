@@ -1,28 +1,189 @@
 import atexit
+import copy
+import httpx
+import importlib.util
 import json
 import random
 import requests
 import re
 import os
+import threading
+import time
 
-from time import sleep
-from typing import Optional, Callable, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Any, Iterator, List, Tuple
 
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from playwright.sync_api import sync_playwright
 from selectorlib import Extractor
 
+import cassette
+import image_store
+from background_loop import run_coroutine
+from single_flight import SingleFlight
+from tracing import span, traced
+from scraper.browser_pool import BrowserPool
+from scraper.compiled_extractor import CompiledExtractor
+from scraper.corpus_cache import CorpusCache
+from scraper.proxy_pool import ProxyPool
+from scraper.scheduler import SUCCESS, THROTTLED, ERROR, backoff_delay, fetch_scheduler
+from scraper.page_readiness import load_products_selector, mark_stale, wait_until_ready, wait_for_element
+
 load_dotenv()
 
 sources = ["amazon", "1688"]
 
-e_amzn = Extractor.from_yaml_file(os.path.join(os.path.dirname(__file__), "layout/amazon_results.yml"))
-e_1688 = Extractor.from_yaml_file(os.path.join(os.path.dirname(__file__), "layout/1688_results.yml"))
-e_16882= Extractor.from_yaml_file(os.path.join(os.path.dirname(__file__), "layout/1688_results_image_search.yml"))
+layouts = {
+    "amazon": os.path.join(os.path.dirname(__file__), "layout/amazon_results.yml"),
+    "1688": os.path.join(os.path.dirname(__file__), "layout/1688_results.yml"),
+    "1688_image_search": os.path.join(os.path.dirname(__file__), "layout/1688_results_image_search.yml"),
+}
+extraction_engines = ["compiled", "selectorlib"]
+
+def load_extractors(engine: str) -> dict:
+    assert engine in extraction_engines, f"engine should be one of {extraction_engines}"
+    extractor_class = CompiledExtractor if engine == "compiled" else Extractor
+    return {layout: extractor_class.from_yaml_file(path) for layout, path in layouts.items()}
+
+# layouts are precompiled to lxml xpath by default, selectorlib remains available as the reference engine
+extractors = load_extractors("compiled")
+
+def set_extraction_engine(engine: str):
+    global extractors
+    extractors = load_extractors(engine)
+
+# product container selectors from the layouts tell the driver when a results page has rendered
+s_amzn = load_products_selector(layouts["amazon"])
+s_1688 = load_products_selector(layouts["1688"])
+s_16882= load_products_selector(layouts["1688_image_search"])
+
+# number of times each layout parsed a page, every fetched page should be parsed exactly once
+parse_counts = {"amazon": 0, "1688": 0, "1688_image_search": 0}
+_parse_counts_lock = threading.Lock()
+
+def extract_products(layout: str, corpus: str) -> Optional[dict]:
+    with _parse_counts_lock:
+        parse_counts[layout] += 1
+    with span("extract_products", "scraper", layout=layout):
+        return extractors[layout].extract(corpus) # products field should always exist but set as None when extraction fails
+
+def parse_stats() -> dict:
+    with _parse_counts_lock:
+        return dict(parse_counts)
+
+# opt-in cache of fetched result pages, consulted before any request or browser work
+corpus_cache: Optional[CorpusCache] = None
+
+def enable_corpus_cache(path: str, max_bytes: int = 512 * 1024 * 1024, ttl: Optional[float] = 24 * 3600) -> CorpusCache:
+    global corpus_cache
+    if corpus_cache is None or corpus_cache.path != path:
+        corpus_cache = CorpusCache(path, max_bytes=max_bytes, ttl=ttl)
+    return corpus_cache
+
+@traced("corpus_cache_lookup", "scraper")
+def get_cached_corpus(layout: str, key: str) -> Tuple[Optional[str], Optional[dict]]:
+    if corpus_cache is None or key is None:
+        return None, None
+    cached = corpus_cache.get(layout, key)
+    if cached is None:
+        return None, None
+    corpus, fetched = cached
+    result = extract_products(layout, corpus)
+    if result is None or result['products'] is None:
+        corpus_cache.invalidate(layout, key)
+        return None, None
+    print(f"[corpus_cache] using {layout} page for {key} fetched {time.time() - fetched:.0f}s ago")
+    return corpus, result
+
+def cache_corpus(layout: str, key: str, corpus: Optional[str], result: Optional[dict]):
+    if corpus_cache is None or key is None or corpus is None:
+        return
+    if is_blocked_page(corpus):
+        return # a captcha or robot check page is never a corpus worth keeping
+    if result is not None and result['products'] is not None:
+        corpus_cache.put(layout, key, corpus)
+
+def image_search_cache_key(image_urls: list) -> Optional[str]:
+    hashes = []
+    for image_url in image_urls:
+        image = image_store.get_image(image_url)
+        if image is None:
+            return None
+        hashes.append(image.sha256)
+    return ",".join(hashes)
+
+amazon_headers = {
+    'dnt': '1',
+    'upgrade-insecure-requests': '1',
+    'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.61 Safari/537.36',
+    'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
+    'sec-fetch-site': 'same-origin',
+    'sec-fetch-mode': 'navigate',
+    'sec-fetch-user': '?1',
+    'sec-fetch-dest': 'document',
+    'referer': 'https://www.amazon.com/',
+    'accept-language': 'en-GB,en-US;q=0.9,en;q=0.8',
+}
+
+# one keep-alive client shared by every search page request (thread safe), negotiating http/2 when
+# the h2 package is installed and compressed responses otherwise handled by httpx
+http_client = httpx.Client(
+    http2=importlib.util.find_spec("h2") is not None,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    timeout=httpx.Timeout(30, connect=10),
+    follow_redirects=True
+)
+
+# markers of amazon's robot check and 1688's slider captcha / punish pages
+blocked_markers = [
+    "To discuss automated access to Amazon data please contact",
+    "/errors/validateCaptcha",
+    "_____tmd_____/punish",
+    "nc_1_n1z",
+]
+
+def is_blocked_page(content: str) -> bool:
+    return any(marker in content for marker in blocked_markers)
+
+def classify_response(response) -> str:
+    if response.status_code == 429 or response.status_code > 500 or is_blocked_page(response.text):
+        return THROTTLED
+    return SUCCESS if response.status_code < 400 else ERROR
+
+# cassette entries for plain get requests, enough of the response for the status and block checks
+def encode_response(response) -> dict:
+    return {"url": str(response.request.url), "status_code": response.status_code, "text": response.text}
+
+def decode_response(entry: dict) -> httpx.Response:
+    return httpx.Response(entry["status_code"], text=entry["text"], request=httpx.Request("GET", entry["url"]))
+
+def classify_page(content: Optional[str]) -> str:
+    if content is None:
+        return ERROR
+    return THROTTLED if is_blocked_page(content) else SUCCESS
+
+# browser work runs on playwright's async api in the shared background loop; contexts are checked
+# out of a pool so several pages can render at once, and the sync functions below can be called
+# from any thread
+browser_pool = BrowserPool(size=3, proxy_provider=lambda: proxy_pool.best(), proxy_reporter=lambda proxy, ok: proxy_pool.report(proxy, ok))
+
+def configure_browser_pool(size: int = 3, headless: bool = False, max_failures: int = 2, max_uses: int = 50) -> BrowserPool:
+    global browser_pool
+    close_browser_instance()
+    browser_pool = BrowserPool(
+        size=size,
+        headless=headless,
+        max_failures=max_failures,
+        max_uses=max_uses,
+        proxy_provider=lambda: proxy_pool.best(),
+        proxy_reporter=lambda proxy, ok: proxy_pool.report(proxy, ok)
+    )
+    return browser_pool
 
-p = sync_playwright().start()
-browser, context, page, proxy_on = None, None, None, None
+# concurrent requests for the same search (e.g. overlapping terms in one exploration level, or the
+# same listing images from two terms) share a single fetch and extraction
+keyword_scrapes = SingleFlight("keyword_scrape")
+image_searches = SingleFlight("image_search")
 
 def scrape( 
     keyword: str,
@@ -31,12 +192,13 @@ def scrape(
     remove_partially_extracted: bool = False,
     remove_sponsored: bool = False,
     result_output: Optional[str] = None,
-    corpus_output: Optional[str] = None
+    corpus_output: Optional[str] = None,
+    use_cache: bool = True
 ) -> Optional[list]:
     
     assert source in sources, f"source should be one of {sources}"
         
-    corpus = get_amazon_corpus(keyword) if source == "amazon" else get_1688_corpus(keyword)
+    corpus, result = fetch_results_page(source, keyword, 1, max_results, use_cache)
     
     if corpus is None:
         print(f"[tl scraper fn] failed to retrieve corpus from web page for {keyword} on {source}")
@@ -46,9 +208,6 @@ def scrape(
         with open(corpus_output, 'w') as outfile:
             outfile.write(corpus)
     
-    e = e_amzn if source == "amazon" else e_1688
-    result = e.extract(corpus) # products field should always exist but set as None when extraction fails   
-
     if result is None or result['products'] is None:
         print("[tl scraper fn] extraction of products from web page failed, recieved the following result")
         print(result)
@@ -68,15 +227,117 @@ def scrape(
     
     return result
 
+@traced("fetch_results_page", "scraper")
+def fetch_results_page(source: str, keyword: str, page: int = 1, expected_results: int = 1, use_cache: bool = True) -> Tuple[Optional[str], Optional[dict]]:
+    cache_key = keyword if page == 1 else f"{keyword}#page={page}"
+    
+    def fetch() -> Tuple[Optional[str], Optional[dict]]:
+        corpus, result = get_cached_corpus(source, cache_key) if use_cache else (None, None)
+        if corpus is None:
+            get_corpus = get_amazon_corpus if source == "amazon" else get_1688_corpus
+            corpus, result = get_corpus(keyword, expected_results, page)
+            cache_corpus(source, cache_key, corpus, result)
+        return corpus, result
+    
+    corpus, result = keyword_scrapes.do((source, keyword, page), fetch)
+    # the extraction may be shared with concurrent callers of the same search, so each gets its own copy
+    return corpus, copy.deepcopy(result)
+
+def iter_scrape(
+    keyword: str,
+    source: str,
+    max_results: int = 7,
+    remove_partially_extracted: bool = False,
+    remove_sponsored: bool = False,
+    result_output: Optional[str] = None,
+    corpus_output: Optional[str] = None,
+    use_cache: bool = True,
+    max_pages: int = 5
+) -> Iterator[dict]:
+    # yields products as soon as their results page is extracted, fetching the next page only when the
+    # consumer asks for more; result_output is appended to per product and corpus_output may contain
+    # {page}, otherwise only the first page is saved
+    assert source in sources, f"source should be one of {sources}"
+    
+    outfile = open(result_output, 'w', encoding="utf-8") if result_output else None
+    try:
+        yielded, seen = 0, set()
+        for page in range(1, max_pages + 1):
+            corpus, result = fetch_results_page(source, keyword, page, max_results - yielded, use_cache)
+            if corpus is None:
+                print(f"[iter_scrape] failed to retrieve page {page} for {keyword} on {source}")
+                return
+            
+            if corpus_output and (page == 1 or "{page}" in corpus_output):
+                with open(corpus_output.format(page=page), 'w') as corpus_file:
+                    corpus_file.write(corpus)
+            
+            if result is None or not result['products']:
+                print(f"[iter_scrape] no products extracted from page {page} for {keyword} on {source}")
+                return
+            
+            products = result['products']
+            if remove_partially_extracted:
+                products = keep_non_null_only(products)
+            
+            for product in products:
+                # results can repeat across pages as listings shift while we paginate
+                if product.get('url') in seen:
+                    continue
+                if product.get('url'):
+                    seen.add(product['url'])
+                if outfile:
+                    json.dump(product, outfile, ensure_ascii=False)
+                    outfile.write("\n")
+                    outfile.flush()
+                yield product
+                yielded += 1
+                if yielded >= max_results:
+                    return
+    finally:
+        if outfile:
+            outfile.close()
+
+def scrape_many(
+    keywords: List[str],
+    source: str = "amazon",
+    max_concurrency: int = 4,
+    result_output: Optional[str] = None,
+    **scrape_kwargs
+) -> List[Optional[list]]:
+    # result_output may contain {keyword}, it is formatted per keyword; results come back in keyword order
+    def scrape_keyword(keyword: str) -> Optional[list]:
+        output = result_output.format(keyword=keyword) if result_output else None
+        try:
+            return scrape(keyword=keyword, source=source, result_output=output, **scrape_kwargs)
+        except Exception as e:
+            print(f"[scrape_many] scraping {keyword} on {source} failed: {e}")
+            return None
+    
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        return list(executor.map(scrape_keyword, keywords))
+
+@traced("scrape_with_1688_image_search", "scraper")
 def scrape_with_1688_image_search(
     image_urls: list,
     max_results: int = 20,
     remove_partially_extracted: bool = False,
     remove_sponsored: bool = False,
     result_output: Optional[str] = None,
-    corpus_output: Optional[str] = None
+    corpus_output: Optional[str] = None,
+    use_cache: bool = True
 ) -> Optional[list]:
-    corpus = get_1688_image_search_corpus(image_urls)
+    def fetch() -> Tuple[Optional[str], Optional[dict]]:
+        cache_key = image_search_cache_key(image_urls) if use_cache and corpus_cache is not None else None
+        corpus, result = get_cached_corpus("1688_image_search", cache_key)
+        if corpus is None:
+            corpus, result = get_1688_image_search_corpus(image_urls, max_results)
+            cache_corpus("1688_image_search", cache_key, corpus, result)
+        return corpus, result
+    
+    corpus, result = image_searches.do(tuple(image_urls), fetch)
+    # product images are rewritten in place below, so never touch the extraction shared with other callers
+    result = copy.deepcopy(result)
     
     if corpus is None:
         print(f"[image scraper fn] failed to retrieve corpus from web page for images {image_urls}")
@@ -86,8 +347,6 @@ def scrape_with_1688_image_search(
         with open(corpus_output, 'w') as outfile:
             outfile.write(corpus)
     
-    result = e_16882.extract(corpus) # products field should always exist but set as None when extraction fails
-    
     if result is None or result['products'] is None:
         print("[image scraper fn] extraction of products from web page failed, recieved the following result")
         print(result)
@@ -114,222 +373,256 @@ def scrape_with_1688_image_search(
     
     return result
     
-def get_amazon_corpus(keyword: str) -> Optional[str]:
-    headers = {
-        'dnt': '1',
-        'upgrade-insecure-requests': '1',
-        'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/83.0.4103.61 Safari/537.36',
-        'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9',
-        'sec-fetch-site': 'same-origin',
-        'sec-fetch-mode': 'navigate',
-        'sec-fetch-user': '?1',
-        'sec-fetch-dest': 'document',
-        'referer': 'https://www.amazon.com/',
-        'accept-language': 'en-GB,en-US;q=0.9,en;q=0.8',
-    }    
-    url = f"https://www.amazon.com/s?k={keyword}"
+@traced("get_amazon_corpus", "scraper")
+def get_amazon_corpus(keyword: str, expected_results: int = 1, page: int = 1) -> Tuple[Optional[str], Optional[dict]]:
+    url = f"https://www.amazon.com/s?k={keyword}" + (f"&page={page}" if page > 1 else "")
     print("[get_amazon_corpus] retrieving corpus with url %s"%url)
     print("[get_amazon_corpus] retrieving page with get request")   
-    r = requests.get(url, headers=headers)
-    
-    # Simple check to check if page was blocked (Usually 503)
-    if r.status_code > 500:
-        if "To discuss automated access to Amazon data please contact" in r.text:
+    try:
+        with span("http_get", "scraper", url=url):
+            r = cassette.call(
+                "http",
+                {"url": url},
+                lambda: fetch_scheduler.call(url, lambda: http_client.get(url, headers=amazon_headers), classify_response),
+                encode=encode_response,
+                decode=decode_response,
+                errors=(httpx.HTTPError,)
+            )
+    except httpx.HTTPError as e:
+        print(f"[get_amazon_corpus] get request failed for {url}: {e}")
+        print("[get_amazon_corpus] re-attempting with webdriver + proxy")
+        page = download_with_driver(url, proxy_url=True, ready_selector=s_amzn, expected_results=expected_results)
+        return page, extract_products("amazon", page) if page is not None else None
+    
+    # still throttled after the scheduler's retries (503, 429 or a captcha page behind a 200)
+    if classify_response(r) == THROTTLED:
+        if is_blocked_page(r.text):
             print("[get_amazon_corpus] rPage %s was blocked by Amazon."%url)
         else:
             print("[get_amazon_corpus] rPage %s must have been blocked by Amazon as the status code was %d"%(url,r.status_code))
         
         print("[get_amazon_corpus] re-attempting to bypass with webdriver + proxy")
-        return download_with_driver(url, proxy_url=True)
-    return r.text
+        page = download_with_driver(url, proxy_url=True, ready_selector=s_amzn, expected_results=expected_results)
+        return page, extract_products("amazon", page) if page is not None else None
+    return r.text, extract_products("amazon", r.text)
     
-def get_1688_corpus(keyword: str) -> Optional[str]:
-    url = f"https://s.1688.com/selloffer/offer_search.htm?keywords={keyword}"
+@traced("get_1688_corpus", "scraper")
+def get_1688_corpus(keyword: str, expected_results: int = 1, page: int = 1) -> Tuple[Optional[str], Optional[dict]]:
+    url = f"https://s.1688.com/selloffer/offer_search.htm?keywords={keyword}" + (f"&beginPage={page}" if page > 1 else "")
     print("[get_1688_corpus] retrieving corpus with url %s"%url)
     
     # cannot use get request because 1688 page renders with javascript
-    page = download_with_driver(url)
+    page = download_with_driver(url, ready_selector=s_1688, expected_results=expected_results)
     
     if page is not None:    
-        extract = e_1688.extract(page) # TODO: have a better way to check if extraction will fail
+        extract = extract_products("1688", page)
         if extract is not None and extract['products'] is not None:
-            return page
+            return page, extract
         
     print("[get_1688_corpus] products cannot be extracted from 1688 web page, retrying page load with proxy")
-    page = download_with_driver(url, proxy_url=True)
+    page = download_with_driver(url, proxy_url=True, ready_selector=s_1688, expected_results=expected_results)
     
-    return page
+    return page, extract_products("1688", page) if page is not None else None
 
-def get_1688_image_search_corpus(image_urls: list) -> Optional[str]:
-    page = download_with_1688_image_search(image_urls)
+@traced("get_1688_image_search_corpus", "scraper")
+def get_1688_image_search_corpus(image_urls: list, expected_results: int = 1) -> Tuple[Optional[str], Optional[dict]]:
+    page = download_with_1688_image_search(image_urls, expected_results=expected_results)
     
+    extract = None
     if page is not None:
-        extract = e_16882.extract(page) # TODO: have a better way to check if extraction will fail
+        extract = extract_products("1688_image_search", page)
         if extract is not None and extract['products'] is not None:
-            return page
+            return page, extract
         
-    print(f"[get_1688_image_search_corpus] products cannot be extracted from 1688 image search page with proxy_on={proxy_on}")
-    # if not proxy_on:
-    #     print("[get_1688_image_search_corpus] proxy is off, retrying page load with proxy")
-    #     page = call_until_not_exception_or_none(
-    #         n=7,
-    #         func=lambda: download_with_1688_image_search(image_urls, proxy=True),
-    #         none_handler=lambda attempt: (
-    #             print(f"[get_1688_image_search_corpus] page download returned None on attempt {attempt}, retrying with new proxy"),
-    #             close_browser_instance(),
-    #             initialize_browser(with_proxy=True)
-    #         )
-    #     )
-    
-    return page
-    
-def download_with_driver(url: str, proxy_url: bool = False, reset_cookies: bool = False) -> Optional[str]:
-    global browser, context, page
-
+    print("[get_1688_image_search_corpus] products cannot be extracted from 1688 image search page")
+    # page = call_until_not_exception_or_none(
+    #     n=7,
+    #     func=lambda: download_with_1688_image_search(image_urls, proxy=True),
+    #     none_handler=lambda attempt: print(f"[get_1688_image_search_corpus] page download returned None on attempt {attempt}, retrying with new proxy")
+    # )
+    
+    return page, extract
+    
+def download_with_driver(
+    url: str,
+    proxy_url: bool = False,
+    reset_cookies: bool = False,
+    ready_selector: Optional[str] = None,
+    expected_results: int = 1,
+    ready_timeout: float = 15000
+) -> Optional[str]:
+    return run_coroutine(adownload_with_driver(url, proxy_url, reset_cookies, ready_selector, expected_results, ready_timeout))
+
+@traced("browser_download", "scraper")
+async def adownload_with_driver(
+    url: str,
+    proxy_url: bool = False,
+    reset_cookies: bool = False,
+    ready_selector: Optional[str] = None,
+    expected_results: int = 1,
+    ready_timeout: float = 15000
+) -> Optional[str]:
+    async def download(url: str) -> Optional[str]:
+        if proxy_url:
+            if not os.getenv('SCRAPER_API_KEY'):
+                print("[driver] no scraper api key found, please set the SCRAPER_API_KEY environment variable")
+                return None
+            url = f"http://api.scraperapi.com?api_key={os.getenv('SCRAPER_API_KEY')}&url={url}"
+
+        return await fetch_scheduler.acall(
+            url,
+            lambda: render_page(url, reset_cookies, ready_selector, expected_results, ready_timeout),
+            classify_page
+        )
+
+    # recorded under the url as given, so the scraperapi key never ends up in a cassette
+    return await cassette.acall("page", {"url": url, "proxy_url": proxy_url}, lambda: download(url), default=None)
+
+@traced("render_page", "scraper")
+async def render_page(url: str, reset_cookies: bool, ready_selector: Optional[str], expected_results: int, ready_timeout: float) -> Optional[str]:
     contents = None
-    
-    if browser is None:
-        print("[driver] browser not initialized, initializing")
-        initialize_browser()
-    
-    if proxy_url:
-        if not os.getenv('SCRAPER_API_KEY'):
-            print("[driver] no scraper api key found, please set the SCRAPER_API_KEY environment variable")
-            return None
-        url = f"http://api.scraperapi.com?api_key={os.getenv('SCRAPER_API_KEY')}&url={url}"
-
+    slot = await browser_pool.acquire()
     try:
         if reset_cookies:
             print("[driver] clearing page cookies")
-            context.clear_cookies()
+            await slot.context.clear_cookies()
         print("[driver] waiting for page render")
-        page.goto(url)
-        sleep(2)
+        await slot.page.goto(url)
+        await wait_until_ready(slot.page, "driver_render", ready_selector, expected_results, ready_timeout)
         print("[driver] downloading %s"%url)
-        contents = page.content()
+        contents = await slot.page.content()
     except Exception as e:
         print("[driver] error occured while scraping page")
         print(e)
+    finally:
+        await browser_pool.release(slot, healthy=contents is not None)
         
     return contents
 
-def download_with_1688_image_search(image_urls: list, proxy: Optional[bool] = None, reset_cookies: bool = False) -> Optional[str]:
-    global browser, context, page, proxy_on
-    
-    if proxy is None:
-        proxy = proxy_on
-    
-    if browser is None or proxy_on != proxy:
-        print("[1688_image_search_driver] initializing browser")
-        initialize_browser(with_proxy=proxy)
-
+def download_with_1688_image_search(
+    image_urls: list,
+    proxy: bool = False,
+    reset_cookies: bool = False,
+    expected_results: int = 1,
+    ready_timeout: float = 15000
+) -> Optional[str]:
+    return run_coroutine(adownload_with_1688_image_search(image_urls, proxy, reset_cookies, expected_results, ready_timeout))
+
+@traced("image_search_download", "scraper")
+async def adownload_with_1688_image_search(
+    image_urls: list,
+    proxy: bool = False,
+    reset_cookies: bool = False,
+    expected_results: int = 1,
+    ready_timeout: float = 15000
+) -> Optional[str]:
+    # images come from the shared image store and are uploaded from memory instead of temp files in the cwd
     outputs = []
-    for i in range(len(image_urls)):
-        response = requests.get(image_urls[i])
-        output = f"image_{i}.jpg"
-        with open(output, 'wb') as file:
-            file.write(response.content)
-        outputs.append(output)
+    for i, image_url in enumerate(image_urls):
+        image = await image_store.aget_image(image_url)
+        if image is None:
+            print(f"[1688_image_search_driver] failed to download image {image_url}")
+            return None
+        outputs.append({"name": f"image_{i}.jpg", "mimeType": image.content_type or "image/jpeg", "buffer": image.data})
         
+    # the upload flow is too expensive to retry here, callers fall back on their own
+    return await cassette.acall(
+        "image_search",
+        {"image_urls": list(image_urls), "proxy": proxy},
+        lambda: fetch_scheduler.acall(
+            "https://s.1688.com/youyuan/index.htm",
+            lambda: run_image_search(outputs, proxy, reset_cookies, expected_results, ready_timeout),
+            classify_page,
+            retries=0
+        ),
+        default=None
+    )
+
+@traced("browser_image_search", "scraper")
+async def run_image_search(outputs: list, proxy: bool, reset_cookies: bool, expected_results: int, ready_timeout: float) -> Optional[str]:
     page_content = None
-        
+    
+    slot = await browser_pool.acquire(with_proxy=proxy)
+    page = slot.page
     try:
         if reset_cookies:
             print("[1688_image_search_driver] clearing page cookies")
-            context.clear_cookies()
+            await slot.context.clear_cookies()
             
         if "s.1688.com/selloffer/offer_search.htm" not in page.url and "s.1688.com/youyuan/index.htm" not in page.url:
             print("[1688_image_search_driver] navigating to 1688's search page")
-            page.goto("https://s.1688.com/selloffer/offer_search.htm?keywords=notepad")
+            await page.goto("https://s.1688.com/selloffer/offer_search.htm?keywords=notepad")
+            await wait_for_element(page, "image_search_upload_button", "div.img-search-upload", ready_timeout)
             print("[1688_image_search_driver] 1688 search page loaded")
-            sleep(3)
         
             print("[1688_image_search_driver] handling potential popup")
-            try_closing_1688_popup()
+            await try_closing_1688_popup(page)
 
-        page.click("div.img-search-upload")
+        # the keyword and image search pages share the card markup, so cards already on the page are
+        # tagged and only the ones rendered for this upload count; network idle would fire on the old page
+        await mark_stale(page, s_16882)
+        
+        await page.click("div.img-search-upload")
         print("[1688_image_search_driver] image upload initiated")
-        sleep(2)
 
-        page.set_input_files("input[type='file']", outputs)
+        # set_input_files waits for the file input to be attached on its own
+        await page.set_input_files("input[type='file']", outputs)
         print("[1688_image_search_driver] input selected")
-        sleep(3)
         
-        page.wait_for_load_state("load")
+        await page.wait_for_load_state("load")
+        await wait_until_ready(page, "image_search_results", f"{s_16882}:not([data-stale])", expected_results, ready_timeout, network_idle=False)
         print("[1688_image_search_driver] image search page loaded")
-        sleep(5)
         
         print("[1688_image_search_driver] downloading search results page")
-        page_content = page.content()
+        page_content = await page.content()
         print("[1688_image_search_driver] download complete")
 
     except Exception as e:
         print(f"[1688_image_search_driver] An error occurred: {e}")
-        return None 
+    finally:
+        await browser_pool.release(slot, healthy=page_content is not None)
     
     return page_content
 
-def initialize_browser(with_proxy: bool = False):
-    global browser, context, page, proxy_on
-
-    userAgentStrings = [
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.2227.0 Safari/537.36',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.3497.92 Safari/537.36',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_0) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36',
-    ]
-
-    proxy_address = None
-    if with_proxy:
-        proxy_address = call_until_not_exception_or_none(3, get_free_proxy_2)
-    proxy_on = proxy_address is not None
-
-    if with_proxy and not proxy_on:
-        print("[initialize_browser] could not retrieve proxy, proceeding without proxy")
-    
-    browser = (
-        p.chromium.launch(headless=False, proxy={
-            "server": proxy_address,
-        })
-        if proxy_on
-        else p.chromium.launch(headless=False)
-    )
-    
-    context = browser.new_context(
-        user_agent=random.choice(userAgentStrings), 
-        ignore_https_errors=True
-    )
-    context.add_init_script("""
-        Object.defineProperty(navigator, 'webdriver', {get: () => undefined})
-        const get_param = (module, param) => {
-            return Object.values(module._nodeModulesPolyfillHeaders)[0][param];
-        }
-        Object.defineProperty(window, 'RTCPeerConnection', {
-            value: get_param(window.RTCPeerConnection, 'mozRTCPeerConnection')
-        });
-        Object.defineProperty(window, 'RTCSessionDescription', {
-            value: get_param(window.RTCSessionDescription, 'mozRTCSessionDescription')
-        });
-    """)
-    context.set_default_timeout(300000)
-   
-    page = context.new_page()
-    
-    sleep(3)
-   
-    print(f"[initialize_browser] browser, context, and page initialized with proxy_on={proxy_on}")
+def download_proxyscrape_list() -> list:
+    url = "https://api.proxyscrape.com/v3/free-proxy-list/get?request=displayproxies&country=us&proxy_format=protocolipport&format=text&timeout=2000"
+    response = fetch_scheduler.call(url, lambda: requests.get(url), classify_response)
+    response.raise_for_status()
+    return [proxy.strip() for proxy in response.text.split('\n') if proxy.strip()]
+
+def download_free_proxy_list() -> list:
+    url = "https://free-proxy-list.net/anonymous-proxy.html"
+    response = fetch_scheduler.call(url, lambda: requests.get(url), classify_response)
+    soup = BeautifulSoup(response.text, 'html.parser')
+    table = soup.find('table')
+    rows = table.tbody.find_all('tr')
+
+    proxies = []
+    for row in rows:
+        cells = row.find_all('td')
+        ip = cells[0].text
+        port = cells[1].text
+        proxies.append(f"{ip}:{port}")
+    return proxies
+
+# candidates from both lists are validated concurrently and scored; contexts and requests that need a
+# proxy get the best scoring one and report back how it did
+proxy_pool = ProxyPool(sources=[download_proxyscrape_list, download_free_proxy_list])
+
+def configure_proxy_pool(**kwargs) -> ProxyPool:
+    global proxy_pool
+    proxy_pool.stop()
+    kwargs.setdefault("sources", [download_proxyscrape_list, download_free_proxy_list])
+    proxy_pool = ProxyPool(**kwargs)
+    return proxy_pool
 
 def get_free_proxy() -> Optional[str]:
     if not hasattr(get_free_proxy, "proxies"):
         get_free_proxy.proxies = []
     
     if not get_free_proxy.proxies:
-        url = "https://api.proxyscrape.com/v3/free-proxy-list/get?request=displayproxies&country=us&proxy_format=protocolipport&format=text&timeout=2000"
-        
         try:
-            response = requests.get(url)
-            response.raise_for_status()
-            get_free_proxy.proxies = [proxy.strip() for proxy in response.text.split('\n') if proxy.strip()]
+            get_free_proxy.proxies = download_proxyscrape_list()
         
         except requests.RequestException as e:
             print(f"[get_free_proxy] An error occurred when downwloading proxy list: {e}")
@@ -344,18 +637,7 @@ def get_free_proxy() -> Optional[str]:
     
 def get_free_proxy_2() -> Optional[str]:
     if not hasattr(get_free_proxy_2, "proxies"):
-        url = "https://free-proxy-list.net/anonymous-proxy.html"
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        table = soup.find('table')
-        rows = table.tbody.find_all('tr')
-
-        get_free_proxy_2.proxies = []
-        for row in rows:
-            cells = row.find_all('td')
-            ip = cells[0].text
-            port = cells[1].text
-            get_free_proxy_2.proxies.append(f"{ip}:{port}")
+        get_free_proxy_2.proxies = download_free_proxy_list()
    
     proxy = random.choice(get_free_proxy_2.proxies)
     print(f"[get_free_proxy_2] selected proxy {proxy}")
@@ -374,11 +656,11 @@ def extract_url_from_css(css_attr: str) -> Optional[str]:
     else:
         return None
 
-def try_closing_1688_popup():
+async def try_closing_1688_popup(page):
     # sometimes, 1688 will display a popup to block webscrapers (this can be closed by pressing the button with class 'baxia-dialog-close')
     # since the exact conditions for the popup is unpredictable, this function is called whenever it is likely to appear
     try:
-        page.click(".baxia-dialog-close", timeout=6000)
+        await page.click(".baxia-dialog-close", timeout=6000)
         print("[close_1688_popup] popup closed")
     except Exception as e:
         print(f"[close_1688_popup] popup close action failed (possibly not present): {e}") 
@@ -386,9 +668,12 @@ def try_closing_1688_popup():
 def call_until_no_exception(
     n: int,
     func: Callable[[], Any],
-    handler: Optional[Callable[[Exception, int], None]] = None
+    handler: Optional[Callable[[Exception, int], None]] = None,
+    base_delay: float = 0.5
 ) -> Any:
     for attempt in range(n):
+        if attempt > 0:
+            time.sleep(backoff_delay(attempt - 1, base_delay))
         try:
             return func()
         except Exception as e:
@@ -402,9 +687,12 @@ def call_until_not_exception_or_none(
     n: int,
     func: Callable[[], Any],
     error_handler: Optional[Callable[[Exception, int], None]] = None,
-    none_handler: Optional[Callable[[int], None]] = None
+    none_handler: Optional[Callable[[int], None]] = None,
+    base_delay: float = 0.5
 ) -> Optional[Any]:
     for attempt in range(n):
+        if attempt > 0:
+            time.sleep(backoff_delay(attempt - 1, base_delay))
         try:
             result = func()
             if result is not None:
@@ -422,15 +710,10 @@ def call_until_not_exception_or_none(
     return None
 
 def close_browser_instance():
-    global browser, context, page, proxy_on
-    if browser is not None:
-        print("[close_browser_instance] closing browser")
-        browser.close()
-    browser, context, page, proxy_on = None, None, None, None
+    run_coroutine(browser_pool.close())
 
 def exit_handler():
     print("application exiting")
     close_browser_instance()
-    p.stop()
 
-atexit.register(exit_handler)
\ No newline at end of file
+atexit.register(exit_handler)
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+# concurrent callers asking for the same key share one underlying operation and its result; works
+# across threads and event loops since waiters block on (or await) a concurrent.futures.Future
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.leaders, self.collapsed = 0, 0
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _join(self, key: Hashable):
+        with self._lock:
+            if key in self._calls:
+                self.collapsed += 1
+                return self._calls[key], False
+            future = Future()
+            self._calls[key] = future
+            self.leaders += 1
+            return future, True
+
+    def _finish(self, key: Hashable):
+        with self._lock:
+            del self._calls[key]
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+            if not future.done():
+                future.set_result(result)
+            return result
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            self._finish(key)
+
+    async def ado(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        future, leader = self._join(key)
+        if not leader:
+            # shielded, so a cancelled follower does not cancel the shared future under the leader
+            # and every other follower
+            return await asyncio.shield(asyncio.wrap_future(future))
+        try:
+            result = await func()
+            if not future.done():
+                future.set_result(result)
+            return result
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            self._finish(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"leaders": self.leaders, "collapsed": self.collapsed, "in_flight": len(self._calls)}
+
+registry = []
+
+def single_flight_stats() -> dict:
+    return {flight.name: flight.stats() for flight in registry}
@@ -0,0 +1,93 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scraper.proxy_pool import ProxyPool
+
+# local stand-ins for public proxies: httpx sends the absolute validate url to them and they answer
+# it themselves, after an optional delay and with the given status
+class StubProxy:
+    def __init__(self, status: int = 200, delay: float = 0.0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests.append(self.path)
+                time.sleep(stub.delay)
+                self.send_response(stub.status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.status = status
+        self.delay = delay
+        self.requests = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def closed_port() -> str:
+    stub = StubProxy()
+    address = stub.address
+    stub.close()
+    return address
+
+def make_pool(candidates: list, **kwargs) -> ProxyPool:
+    return ProxyPool(sources=[lambda: candidates], validate_url="http://validate.test/robots.txt", validate_timeout=5, **kwargs)
+
+def test_validates_and_ejects_candidates():
+    good, broken = StubProxy(), StubProxy(status=502)
+    dead = closed_port()
+    pool = make_pool([good.address, broken.address, dead], min_ready=3)
+    try:
+        assert pool.best() == f"http://{good.address}"
+        assert good.requests == ["http://validate.test/robots.txt"]
+        stats = pool.stats()
+        assert stats["healthy"] == 1
+        assert stats["ejected"] == 2
+    finally:
+        pool.stop()
+        good.close()
+        broken.close()
+
+def test_best_returns_before_slow_candidates_are_validated():
+    fast = [StubProxy() for _ in range(2)]
+    slow = StubProxy(delay=2)
+    pool = make_pool([slow.address] + [stub.address for stub in fast], min_ready=2)
+    try:
+        start = time.perf_counter()
+        proxy = pool.best()
+        assert time.perf_counter() - start < 1.5
+        assert proxy in [f"http://{stub.address}" for stub in fast]
+        assert pool.refreshes == 0 # the first refresh is still validating the slow candidate
+
+        deadline = time.time() + 5
+        while pool.refreshes == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        assert pool.stats()["healthy"] == 3
+    finally:
+        pool.stop()
+        for stub in fast + [slow]:
+            stub.close()
+
+def test_report_ejects_failing_proxy():
+    good = StubProxy()
+    pool = make_pool([good.address], min_ready=1, max_consecutive_failures=2)
+    try:
+        proxy = pool.best()
+        pool.report(proxy, False)
+        pool.report(proxy, False)
+        assert pool.best() is None
+    finally:
+        pool.stop()
+        good.close()
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+
+from single_flight import SingleFlight
+
+def test_collapses_concurrent_calls():
+    flight = SingleFlight("test_collapse")
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "done"
+
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", work)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(flight.do("key", work)))
+    follower.start()
+    while flight.stats()["collapsed"] == 0:
+        time.sleep(0.001)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert results == ["done", "done"]
+    assert len(calls) == 1
+    assert flight.stats() == {"leaders": 1, "collapsed": 1, "in_flight": 0}
+
+def test_cancelled_follower_does_not_cancel_the_others():
+    flight = SingleFlight("test_cancel")
+
+    async def main():
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return "done"
+
+        leader = asyncio.create_task(flight.ado("key", work))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(flight.ado("key", work))
+        follower = asyncio.create_task(flight.ado("key", work))
+        await asyncio.sleep(0)
+        assert flight.stats()["collapsed"] == 2
+
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(leader, follower, cancelled, return_exceptions=True)
+
+    leader, follower, cancelled = asyncio.run(main())
+    assert leader == "done"
+    assert follower == "done"
+    assert isinstance(cancelled, asyncio.CancelledError)
+    assert flight.stats()["in_flight"] == 0
+
+def test_leader_exception_reaches_followers():
+    flight = SingleFlight("test_exception")
+
+    async def main():
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            raise ValueError("failed")
+
+        leader = asyncio.create_task(flight.ado("key", work))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.ado("key", work))
+        await asyncio.sleep(0)
+        release.set()
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, ValueError) for result in results)
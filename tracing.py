@@ -0,0 +1,144 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+
+# nested timing spans for the exploration pipeline, written as a chrome trace (chrome://tracing or
+# https://ui.perfetto.dev) plus a hotspot report; spans are no-ops unless a tracer is started
+
+class Span:
+    __slots__ = ["name", "category", "args", "parent", "children_seconds"]
+
+    def __init__(self, name: str, category: str, args: dict, parent: Optional["Span"]):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.parent = parent
+        self.children_seconds = 0.0
+
+class Tracer:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.totals = {} # span name -> [calls, total seconds, self seconds, max seconds]
+        self._task_tids = {}
+        self._thread_names = {}
+        self._lock = threading.Lock()
+
+    def _tid(self) -> int:
+        # coroutines interleave on the background loop thread, so each asyncio task gets a lane of its
+        # own to keep the chrome viewer's per thread nesting intact
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is None:
+            tid = threading.get_ident()
+            name = threading.current_thread().name
+        else:
+            tid = self._task_tids.setdefault(id(task), 1_000_000 + len(self._task_tids))
+            name = f"asyncio {task.get_name()}"
+        if tid not in self._thread_names:
+            self._thread_names[tid] = name
+        return tid
+
+    def record(self, span: Span, start: float, seconds: float):
+        self_seconds = max(0.0, seconds - span.children_seconds)
+        with self._lock:
+            tid = self._tid()
+            self.events.append({
+                "name": span.name,
+                "cat": span.category,
+                "ph": "X",
+                "ts": round((start - self.origin) * 1e6, 1),
+                "dur": round(seconds * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": span.args,
+            })
+            totals = self.totals.setdefault(span.name, [0, 0.0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += self_seconds
+            totals[3] = max(totals[3], seconds)
+            if span.parent is not None:
+                span.parent.children_seconds += seconds
+
+    def write_chrome_trace(self, output_path: str):
+        with self._lock:
+            metadata = [
+                {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                for tid, name in self._thread_names.items()
+            ]
+            events = list(self.events)
+        with open(output_path, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, file, ensure_ascii=False, default=str)
+
+    def hotspots(self) -> List[dict]:
+        with self._lock:
+            rows = [
+                {"stage": name, "calls": calls, "total_seconds": total, "self_seconds": self_seconds, "mean_seconds": total / calls, "max_seconds": longest}
+                for name, (calls, total, self_seconds, longest) in self.totals.items()
+            ]
+        return sorted(rows, key=lambda row: row["total_seconds"], reverse=True)
+
+    def hotspot_report(self, top: int = 20) -> str:
+        # total is cumulative over calls (concurrent calls overlap, so it can exceed wall time), self
+        # excludes time spent in child spans
+        lines = [f"{'stage':<44} {'calls':>6} {'total s':>9} {'self s':>9} {'mean s':>8} {'max s':>8}"]
+        for row in self.hotspots()[:top]:
+            lines.append(f"{row['stage']:<44} {row['calls']:>6} {row['total_seconds']:>9.2f} {row['self_seconds']:>9.2f} {row['mean_seconds']:>8.3f} {row['max_seconds']:>8.2f}")
+        return "\n".join(lines)
+
+tracer: Optional[Tracer] = None
+current_span = contextvars.ContextVar("current_span", default=None)
+
+def start_tracing() -> Tracer:
+    global tracer
+    tracer = Tracer()
+    return tracer
+
+def stop_tracing() -> Optional[Tracer]:
+    global tracer
+    stopped, tracer = tracer, None
+    return stopped
+
+@contextmanager
+def span(name: str, category: str = "", **args) -> Iterator[Optional[Span]]:
+    active = tracer
+    if active is None:
+        yield None
+        return
+    current = Span(name, category, args, current_span.get())
+    token = current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        seconds = time.perf_counter() - start
+        current_span.reset(token)
+        active.record(current, start, seconds)
+
+def traced(name: Optional[str] = None, category: str = "") -> Callable:
+    # decorator form of span for plain and async functions
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name, category):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator